@@ -1,27 +1,305 @@
 #!/usr/bin/env python3
-import requests
+import time
+_start_time = time.time()
 import logging
 logging.basicConfig(level='DEBUG')
-import json
 from typing import List, Tuple
 #import time
 #import sys
 #import math
-from flask import Flask, request, send_file
+from flask import Flask, request, send_file, Response
 import redis
 import os
+import math
+import functools
+import threading
 from datetime import date
-from jobs import add_job, get_job_by_id, get_job_ids, get_result
+from jobs import submit_job, get_job_by_id, get_job_ids, get_result, cancel_job, PRIORITIES
+from spatial import KDTree, sky_to_cartesian, angle_to_chord, chord_to_angle
+from storage import rd, idx, count_rows, save_rows, save_columns, delete_rows, get_row, get_rows, get_fields
+from storage import save_systems, delete_systems, get_systems, get_system, get_system_names
+from storage import get_columns as get_dataset_columns
 
 #Instantiate Flask object
 app = Flask(__name__)
+_served_first_request = False
 #Instantiate Redis object
 #path /data will be mounted on the port when the container is composed
 redis_ip = os.environ.get('REDIS_IP')
 log_level = os.environ.get('LOG_LEVEL')
-rd = redis.Redis(host=redis_ip, port=6379, db=0)
 logging.basicConfig(level=log_level)
 
+#Numeric columns that get a sorted-set index for range searches
+RANGE_COLUMNS = ["pl_masse", "pl_rade", "pl_orbper", "pl_orbsmax", "sy_dist",
+                 "disc_year", "st_teff"]
+
+#Name columns that get a lexicographic index for autocomplete
+NAME_COLUMNS = ["pl_name", "hostname"]
+
+#In-memory column arrays for statistics, and the statistics memoized from
+#them, replaced as a whole whenever the dataset version changes
+_column_cache = {"version": None, "columns": {}, "stats": None}
+
+#In-memory spatial indexes, rebuilt whenever the dataset version changes
+_spatial_index = {"version": None, "sky": None, "space": None, "names": {}}
+#Set once the in-memory indexes have been built at startup, see _warm_indexes
+_indexes_ready = threading.Event()
+#Only one thread at a time rebuilds the Redis indexes, see _ensure_indexes
+_indexes_lock = threading.Lock()
+
+def _dataset_version() -> int:
+    '''
+    Returns the current dataset version, which is bumped on every load or
+    deletion so that in-memory indexes know when to rebuild
+
+    Args: None
+    Returns:
+        version (int): the dataset version, 0 if never loaded
+    '''
+    version = idx.get("dataset_version")
+    if version is None:
+        return 0
+    return int(version)
+
+def _build_spatial_index(list_of_dicts: List[dict], version: int) -> None:
+    '''
+    Builds k-d trees over the planets' positions. The "sky" tree holds unit
+    vectors from ra/dec for cone searches, and the "space" tree holds 3D
+    positions in parsecs (using sy_dist) for nearest-neighbor searches.
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset, indexed as in Redis
+        version (int): the dataset version this index corresponds to
+    Returns: none
+    '''
+    sky_points, sky_ids, space_points, space_ids = [], [], [], []
+    names = {}
+    for i in range(len(list_of_dicts)):
+        if "pl_name" in list_of_dicts[i]:
+            names[list_of_dicts[i]["pl_name"]] = i
+        ra = list_of_dicts[i].get("ra")
+        dec = list_of_dicts[i].get("dec")
+        dist = list_of_dicts[i].get("sy_dist")
+        #Sparse data - skip planets without a sky position
+        if not isinstance(ra, (int, float)) or not isinstance(dec, (int, float)):
+            continue
+        sky_points.append(sky_to_cartesian(ra, dec))
+        sky_ids.append(i)
+        if isinstance(dist, (int, float)):
+            space_points.append(sky_to_cartesian(ra, dec, dist))
+            space_ids.append(i)
+
+    _spatial_index["sky"] = KDTree(sky_points, sky_ids)
+    _spatial_index["space"] = KDTree(space_points, space_ids)
+    _spatial_index["names"] = names
+    _spatial_index["version"] = version
+    logging.info(f'Spatial index built over {len(sky_ids)} planets')
+    return
+
+def _build_range_index(list_of_dicts: List[dict]) -> None:
+    '''
+    Builds one Redis sorted set per column in RANGE_COLUMNS, with each planet's
+    index as the member and its value as the score, so that range queries
+    can be answered with ZRANGEBYSCORE instead of a scan
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset, indexed as in Redis
+    Returns: none
+    '''
+    pipe = idx.pipeline()
+    for column in RANGE_COLUMNS:
+        pipe.delete(f'range:{column}')
+        scores = {}
+        for i in range(len(list_of_dicts)):
+            value = list_of_dicts[i].get(column)
+            #Sparse data - planets without a value are left out of the index
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                scores[i] = value
+        if len(scores) > 0:
+            pipe.zadd(f'range:{column}', scores)
+    pipe.execute()
+    return
+
+def _build_name_index(list_of_dicts: List[dict]) -> None:
+    '''
+    Builds two Redis sorted sets per column in NAME_COLUMNS, with every score
+    0 so that members are ordered lexicographically and prefixes can be found
+    with ZRANGEBYLEX. "lex:<column>" holds the names themselves, and
+    "lexci:<column>" holds "<lowercased name>\\0<name>" for case-insensitive
+    matching.
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset, indexed as in Redis
+    Returns: none
+    '''
+    pipe = idx.pipeline()
+    for column in NAME_COLUMNS:
+        pipe.delete(f'lex:{column}', f'lexci:{column}')
+        names = set()
+        for planet in list_of_dicts:
+            if isinstance(planet.get(column), str):
+                names.add(planet[column])
+        if len(names) > 0:
+            pipe.zadd(f'lex:{column}', {name: 0 for name in names})
+            pipe.zadd(f'lexci:{column}', {f'{name.lower()}\0{name}': 0 for name in names})
+    pipe.execute()
+    return
+
+def _build_indexes(list_of_dicts: List[dict]) -> None:
+    '''
+    Builds every Redis index over the dataset: the range and name indexes and
+    the systems table. The "indexed" key is set last, to mark them complete.
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset, indexed as in Redis
+    Returns: none
+    '''
+    _build_range_index(list_of_dicts)
+    _build_name_index(list_of_dicts)
+    save_systems(list_of_dicts)
+    idx.set("indexed", 1)
+    return
+
+def _ensure_indexes() -> None:
+    '''
+    Builds the Redis indexes from the stored rows if data is loaded but was
+    never indexed, e.g. because it was loaded by an older version of this API
+    and kept by Redis across the upgrade
+
+    Args: none
+    Returns: none
+    '''
+    if idx.exists("indexed") or count_rows() == 0:
+        return
+    with _indexes_lock:
+        if idx.exists("indexed"):
+            return
+        logging.warning(f'Data has no indexes, building them from the stored rows')
+        list_of_dicts = get_rows()
+        save_columns(list_of_dicts)
+        _build_indexes(list_of_dicts)
+    return
+
+def _is_planet(pl_name: str) -> bool:
+    '''
+    Checks whether a planet name exists, using the name index
+
+    Args:
+        pl_name (str): the planet name to check
+    Returns:
+        exists (bool): True if a planet has this exact name
+    '''
+    return isinstance(pl_name, str) and idx.zscore("lex:pl_name", pl_name) is not None
+
+def _build_columns(list_of_dicts: List[dict], version: int) -> None:
+    '''
+    Builds a NumPy float array for every numeric column in one pass over the
+    dataset, with NaN where a planet has no value. A column is numeric if it
+    has at least one number and no strings.
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset, indexed as in Redis
+        version (int): the dataset version these arrays correspond to
+    Returns: none
+    '''
+    import numpy as np
+
+    values = {}
+    not_numeric = set()
+    for i in range(len(list_of_dicts)):
+        for column, value in list_of_dicts[i].items():
+            if column in not_numeric or value is None:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values.setdefault(column, {})[i] = value
+            else:
+                not_numeric.add(column)
+
+    columns = {}
+    for column, column_values in values.items():
+        if column in not_numeric:
+            continue
+        array = np.full(len(list_of_dicts), np.nan)
+        array[list(column_values.keys())] = list(column_values.values())
+        columns[column] = array
+
+    #A new snapshot replaces the old one at once, so a request never mixes
+    #arrays or memoized statistics from two versions
+    global _column_cache
+    _column_cache = {"version": version,
+                     "columns": columns,
+                     "stats": functools.lru_cache(maxsize=256)(
+                         functools.partial(_column_stats, columns))}
+    return
+
+def _get_columns() -> dict:
+    '''
+    Returns the numeric column arrays, rebuilding them first if the dataset
+    has been reloaded since they were built
+
+    Args: None
+    Returns:
+        snapshot (dict): the dataset "version", a "columns" dictionary mapping
+            column names to NumPy arrays, and a "stats" function that returns
+            _column_stats for those arrays, memoized
+    '''
+    version = _dataset_version()
+    if _column_cache["version"] != version:
+        _build_columns(get_rows(), version)
+    return _column_cache
+
+def _column_stats(columns: dict, column: str, bins: int,
+                  percentiles: Tuple[float, ...]) -> dict:
+    '''
+    Computes summary statistics and a histogram for a numeric column. Each
+    column snapshot memoizes this, so repeated requests cost nothing.
+
+    Args:
+        columns (dict): the column arrays to compute from
+        column (str): the name of a numeric column
+        bins (int): the number of equal-width histogram bins
+        percentiles (tuple): the percentiles to compute, between 0 and 100
+    Returns:
+        stats (dict): the column's statistics
+    '''
+    import numpy as np
+
+    array = columns[column]
+    values = array[~np.isnan(array)]
+    stats = {"column": column,
+             "count": int(values.size),
+             "null_count": int(array.size - values.size),
+             "min": None, "max": None, "mean": None, "std": None,
+             "percentiles": {},
+             "histogram": {"edges": [], "counts": []}}
+    if values.size == 0:
+        return stats
+
+    stats["min"] = float(values.min())
+    stats["max"] = float(values.max())
+    stats["mean"] = float(values.mean())
+    stats["std"] = float(values.std())
+    points = np.percentile(values, percentiles)
+    stats["percentiles"] = {f'{p:g}': float(v) for p, v in zip(percentiles, points)}
+    counts, edges = np.histogram(values, bins=bins)
+    stats["histogram"] = {"edges": edges.tolist(), "counts": counts.tolist()}
+    return stats
+
+def _get_spatial_index() -> dict:
+    '''
+    Returns the spatial index, rebuilding it first if the dataset has been
+    reloaded since it was built (e.g. by another API replica)
+
+    Args: None
+    Returns:
+        index (dict): the dict holding the "sky" and "space" k-d trees, and
+            a "names" dict mapping planet names to their indices
+    '''
+    version = _dataset_version()
+    if _spatial_index["version"] != version:
+        _build_spatial_index(get_fields(["pl_name", "ra", "dec", "sy_dist"]), version)
+    return _spatial_index
+
 #Load the exoplanet data to Redis database from the web
 @app.route('/data', methods=['POST'])
 def load_exoplanet_data() -> str:
@@ -34,6 +312,9 @@ def load_exoplanet_data() -> str:
         output (str): a string that tells user whether method was successful
     '''
 
+    #requests is only needed here, so it is not imported at startup
+    import requests
+
     list_of_dicts = []
     try:
         response = requests.get(url="https://exoplanetarchive.ipac.caltech.edu/TAP/sync?query=select+*+from+ps+where+default_flag=1&format=json")
@@ -46,10 +327,15 @@ def load_exoplanet_data() -> str:
         logging.error(f'Data in incorrect format')
         return "Data load failed\n"
 
-    #save to Redis - since Redis is unordered, iterate through indices and use
-    #json.dumps() to load it to Redis and json.loads() to take it out
-    for i in range(len(list_of_dicts)):
-        rd.set(i, json.dumps(list_of_dicts[i]))
+    #save to Redis - since Redis is unordered, planet i is stored at key i,
+    #in the layout chosen in storage.py
+    save_rows(list_of_dicts)
+
+    #Rebuild the indexes for the new data
+    version = idx.incr("dataset_version")
+    _build_spatial_index(list_of_dicts, version)
+    _build_columns(list_of_dicts, version)
+    _build_indexes(list_of_dicts)
 
     return "Data load succeeded\n"
 
@@ -65,20 +351,12 @@ def return_exoplanet_data() -> List[dict]:
             exoplanet dataset
     '''
     list_of_dicts = []
-    indices = 0
     try:
-        indices = len(rd.keys())
+        #in case of error, rows are returned as empty key-value pairs
+        list_of_dicts = get_rows()
     except ConnectionError:
         logging.error(f'Database not found')
 
-    #load data from Redis database
-    for i in range(indices):
-        try:
-            list_of_dicts.append(json.loads(rd.get(i)))
-            #in case of error, append empty key-value pair
-        except (TypeError, json.decoder.JSONDecodeError):
-            list_of_dicts.append({})
-
     return list_of_dicts
 
 #Delete all data from Redis
@@ -92,17 +370,20 @@ def delete_exoplanet_data() -> str:
     Returns:
         output (str): a string that tells user whether method was successful
     '''
-    indices = 0
     try:
-        indices = len(rd.keys())
+        delete_rows()
     except ConnectionError:
         logging.error(f'Database not found')
         return "Deletion failed\n"
 
-    for i in range(indices):
-        rd.delete(i)
+    idx.incr("dataset_version")
+    idx.delete("indexed")
+    idx.delete(*[f'range:{column}' for column in RANGE_COLUMNS])
+    idx.delete(*[f'{prefix}:{column}' for prefix in ("lex", "lexci")
+                 for column in NAME_COLUMNS])
+    delete_systems()
 
-    if(len(rd.keys()) == 0):
+    if(count_rows() == 0):
         return "Deletion succeeded\n"
     else:
         return "Deletion failed\n"
@@ -118,22 +399,15 @@ def return_planets() -> list:
         planets (list): a list of all planet name strings
     '''
     planets = []
-    indices = 0
+    list_of_dicts = []
     try:
-        indices = len(rd.keys())
+        list_of_dicts = get_fields(["pl_name"])
     except ConnectionError:
         logging.error(f'Database not found')
 
-    for i in range(indices):
-        dict_i = {}
-        try:
-            dict_i = json.loads(rd.get(i))
-        except (TypeError, json.decoder.JSONDecodeError):
-            continue
-        try:
+    for dict_i in list_of_dicts:
+        if dict_i["pl_name"] is not None:
             planets.append(dict_i["pl_name"])
-        except KeyError:
-            continue
 
     return planets
 
@@ -149,32 +423,221 @@ def return_planet_info(pl_name: str) -> dict:
         data (dict): a dictionary containing the data for the planet whose was
         given
     '''
-    data = {}
-    indices = 0
+    #only the names are scanned; the full row is fetched once it is found
+    list_of_dicts = []
     try:
-        indices = len(rd.keys())
+        list_of_dicts = get_fields(["pl_name"])
     except ConnectionError:
         logging.error(f'Database not found')
 
-    #let's check whether id is a valid id using the return_planets() function
-    planet_list = return_planets()
-    if((pl_name in planet_list) == False):
-        return {"Planet name not found": 0}
+    for i in range(len(list_of_dicts)):
+        if list_of_dicts[i]["pl_name"] == pl_name:
+            return get_row(i)
+    return {"Planet name not found": 0}
+
+#Route to suggest planet or host names that start with a prefix
+@app.route('/planets/suggest', methods=['GET'])
+def suggest_names():
+    '''
+    This function returns the names that start with a given prefix, in
+    alphabetical order, using the lexicographic name index.
+
+    Args: none. This function reads the query parameters "q" (the prefix),
+        "field" ("pl_name" or "hostname", default "pl_name"), "limit"
+        (default 10, at most 100) and "ignore_case" (default false)
+    Returns:
+        names (list): the matching names
+    '''
+    prefix = request.args.get("q", "")
+    field = request.args.get("field", "pl_name")
+    ignore_case = request.args.get("ignore_case", "false").lower() in ("1", "true", "yes")
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        return "Query parameter limit must be an integer\n", 400
+    if field not in NAME_COLUMNS:
+        return f'Query parameter field must be one of {NAME_COLUMNS}\n', 400
+    if limit < 1 or limit > 100:
+        return "Query parameter limit must be between 1 and 100\n", 400
+
+    _ensure_indexes()
+    key = f'lex:{field}'
+    if ignore_case:
+        key = f'lexci:{field}'
+        prefix = prefix.lower()
+    #Every member starting with the prefix sorts between "prefix" and
+    #"prefix" followed by the largest possible byte
+    low = b'[' + prefix.encode("utf-8")
+    high = b'[' + prefix.encode("utf-8") + b'\xff'
+    members = idx.zrangebylex(key, low, high, start=0, num=limit)
+
+    names = []
+    for member in members:
+        name = member.decode("utf-8")
+        if ignore_case:
+            name = name.split("\0", 1)[1]
+        names.append(name)
+    return names
+
+#Route to search planets by ranges of numeric columns
+@app.route('/planets/search', methods=['GET'])
+def search_planets():
+    '''
+    This function returns the planets whose numeric columns fall within the
+    given bounds, using the sorted-set indexes. The predicate with the fewest
+    matches is fetched first, and the remaining predicates only check those
+    candidates.
+
+    Args: none. This function reads the query parameters "<column>_min" and
+        "<column>_max" (inclusive) for any column in RANGE_COLUMNS, "fields"
+        (a comma-separated list of columns to return, default all), "offset"
+        (default 0) and "limit" (default 100, at most 1000)
+    Returns:
+        output (dict): the total number of matches, the offset and limit, and
+        a "results" list with the requested page of planets
+    '''
+    bounds = {}
+    try:
+        for column in RANGE_COLUMNS:
+            low = request.args.get(f'{column}_min')
+            high = request.args.get(f'{column}_max')
+            if low is not None or high is not None:
+                bounds[column] = (float(low) if low is not None else float("-inf"),
+                                  float(high) if high is not None else float("inf"))
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return "Bounds must be numbers, and offset and limit integers\n", 400
+    if any(math.isnan(bound) for pair in bounds.values() for bound in pair):
+        return "Bounds must not be NaN\n", 400
+    if len(bounds) == 0:
+        return f'Give at least one bound: <column>_min or <column>_max for a column in {RANGE_COLUMNS}\n', 400
+    if offset < 0 or limit < 1 or limit > 1000:
+        return "Offset must be non-negative and limit between 1 and 1000\n", 400
+    fields = None
+    if request.args.get("fields"):
+        fields = request.args["fields"].split(",")
+
+    #Order the predicates by how many planets they match
+    _ensure_indexes()
+    pipe = idx.pipeline()
+    for column, (low, high) in bounds.items():
+        pipe.zcount(f'range:{column}', low, high)
+    counts = pipe.execute()
+    predicates = sorted(zip(counts, bounds.keys()))
+
+    first = predicates[0][1]
+    candidates = idx.zrangebyscore(f'range:{first}', *bounds[first])
+    for count, column in predicates[1:]:
+        if len(candidates) == 0:
+            break
+        low, high = bounds[column]
+        scores = idx.zmscore(f'range:{column}', candidates)
+        candidates = [candidates[j] for j in range(len(candidates))
+                      if scores[j] is not None and low <= scores[j] <= high]
+
+    #Return matches in dataset order so that pages are stable
+    matches = sorted(int(i) for i in candidates)
+    page = matches[offset:offset + limit]
+    if fields is not None:
+        results = get_fields(fields, page)
     else:
-        #iterate through database
-        for i in range(indices):
-            data = {}
-            is_planet = False
-            try:
-                data = json.loads(rd.get(i))
-            except (TypeError, json.decoder.JSONDecodeError):
-                continue
-            try:
-                is_planet = (data["pl_name"] == pl_name)
-            except KeyError:
-                continue
-            if(is_planet):
-                return data
+        results = get_rows(page)
+
+    return {"total": len(matches),
+            "offset": offset,
+            "limit": limit,
+            "results": results}
+
+#Most planets returned by one cone or nearest-neighbor search
+MAX_NEIGHBORS = 1000
+#Fields returned for each match of a positional search
+POSITION_FIELDS = ["pl_name", "hostname", "ra", "dec", "sy_dist"]
+
+def _position_summaries(indices: List[int]) -> List[dict]:
+    '''
+    Returns the identifying and positional fields of many planets, fetched
+    together rather than one row at a time
+
+    Args:
+        indices (list[int]): the planets' indices in the Redis database
+    Returns:
+        summaries (list[dict]): each planet's name, host, ra, dec and distance,
+            in the order of indices
+    '''
+    return get_fields(POSITION_FIELDS, indices)
+
+#Route to return all planets within a cone on the sky
+@app.route('/planets/near', methods=['GET'])
+def planets_near():
+    '''
+    This function returns all planets within an angular radius of a point on
+    the sky, using the spatial index instead of scanning the dataset.
+
+    Args: none. This function reads the query parameters "ra" and "dec" (the
+        center of the cone, in degrees), "radius" (in degrees, default 1) and
+        "limit" (default 100, at most MAX_NEIGHBORS)
+    Returns:
+        planets (list[dict]): the closest "limit" matching planets, closest
+        first, each with its angular separation in degrees
+    '''
+    try:
+        ra = float(request.args["ra"])
+        dec = float(request.args["dec"])
+        radius = float(request.args.get("radius", 1.0))
+        limit = int(request.args.get("limit", 100))
+    except (KeyError, ValueError):
+        return "Query parameters ra and dec (and optionally radius) must be numbers, and limit an integer\n", 400
+    if not (math.isfinite(ra) and math.isfinite(radius) and radius >= 0 and -90 <= dec <= 90):
+        return "Invalid cone: ra and radius must be finite, dec within [-90, 90] and radius positive\n", 400
+    if limit < 1 or limit > MAX_NEIGHBORS:
+        return f'Query parameter limit must be between 1 and {MAX_NEIGHBORS}\n', 400
+
+    tree = _get_spatial_index()["sky"]
+    matches = tree.query_radius(sky_to_cartesian(ra, dec), angle_to_chord(radius))[:limit]
+    planets = _position_summaries([i for chord, i in matches])
+    for planet, (chord, i) in zip(planets, matches):
+        planet["separation_deg"] = chord_to_angle(chord)
+    return planets
+
+#Route to return the nearest planets in space to a given planet
+@app.route('/planets/<string:pl_name>/neighbors', methods=['GET'])
+def planet_neighbors(pl_name: str):
+    '''
+    This function returns the k planets closest in 3D space to a given planet,
+    using its sky position and distance.
+
+    Args:
+        pl_name (string): a string corresponding to the name of the planet
+        This function also reads the query parameter "k" (default 5, at most
+        MAX_NEIGHBORS)
+    Returns:
+        planets (list[dict]): the k nearest planets, closest first, each with
+        its distance from the given planet in parsecs
+    '''
+    try:
+        k = int(request.args.get("k", 5))
+    except ValueError:
+        return "Query parameter k must be an integer\n", 400
+    if k < 1 or k > MAX_NEIGHBORS:
+        return f'Query parameter k must be between 1 and {MAX_NEIGHBORS}\n', 400
+
+    index = _get_spatial_index()
+    if pl_name not in index["names"]:
+        return {"Planet name not found": 0}
+    data = get_row(index["names"][pl_name])
+    try:
+        point = sky_to_cartesian(data["ra"], data["dec"], data["sy_dist"])
+    except (KeyError, TypeError):
+        return {"Planet has no known position": 0}
+
+    #Ask for one extra, since the planet itself is always its own closest match
+    matches = [(dist, i) for dist, i in index["space"].query_knn(point, k + 1)
+               if i != index["names"][pl_name]][:k]
+    planets = _position_summaries([i for dist, i in matches])
+    for planet, (dist, i) in zip(planets, matches):
+        planet["distance_pc"] = dist
+    return planets
 
 #Route to return number of planets
 @app.route('/planets/number', methods=['GET'])
@@ -203,9 +666,9 @@ def planets_per_facility() -> dict:
         data (dict): a dictionary containing information about how many planets
         were discovered at each facility
     '''
-    #Retrieve data from rd, iterate through list of dicts
+    #Retrieve only the needed field from rd, iterate through list of dicts
     #Then populate the dict with data and return
-    list_of_dicts = return_exoplanet_data()
+    list_of_dicts = get_fields(["disc_facility"])
     facility_dict = {}
 
     for i in list_of_dicts:
@@ -233,9 +696,9 @@ def planets_per_year() -> dict:
         data (dict): a dictionary containing information about how many planets
         were discovered each year
     '''
-    #Retrieve data from rd, iterate through list of dicts
+    #Retrieve only the needed field from rd, iterate through list of dicts
     #Then populate the dict with data and return
-    list_of_dicts = return_exoplanet_data()
+    list_of_dicts = get_fields(["disc_year"])
     year_dict = {}
 
     for i in list_of_dicts:
@@ -263,9 +726,9 @@ def planets_per_method() -> dict:
         data (dict): a dictionary containing information about how many planets
         were discovered via each discovery method
     '''
-    #Retrieve data from rd, iterate through list of dicts
+    #Retrieve only the needed field from rd, iterate through list of dicts
     #Then populate the dict with data and return
-    list_of_dicts = return_exoplanet_data()
+    list_of_dicts = get_fields(["discoverymethod"])
     method_dict = {}
 
     for i in list_of_dicts:
@@ -292,22 +755,12 @@ def avg_planets_per_system() -> str:
     Returns:
         output (str): a string describing the average number of planets per system
     '''
-    list_of_dicts = return_exoplanet_data()
-    system_planet_counts = {}
-
-    for planet in list_of_dicts:
-        try:
-            hostname = planet["hostname"]
-        except KeyError:
-            continue
-
-        if hostname not in system_planet_counts:
-            system_planet_counts[hostname] = 1
-        else:
-            system_planet_counts[hostname] += 1
+    #Planet counts are materialized per system when the data is loaded
+    _ensure_indexes()
+    systems = get_systems()
 
-    total_systems = len(system_planet_counts)
-    total_planets = sum(system_planet_counts.values())
+    total_systems = len(systems)
+    total_planets = sum(system["planet_count"] for system in systems)
 
     if total_systems == 0:
         return "No star systems found to compute average.\n"
@@ -326,24 +779,17 @@ def avg_stars_per_system() -> str:
     Returns:
         output (str): a string describing the average number of stars per system
     '''
-    list_of_dicts = return_exoplanet_data()
-    system_star_counts = {}
-
-    for planet in list_of_dicts:
-        try:
-            hostname = planet["hostname"]
-            stars = planet["sy_snum"]
-        except KeyError:
-            continue
+    #Each system record already holds a single star count
+    _ensure_indexes()
+    system_star_counts = []
 
-        # Only record one star count per unique hostname
-        if hostname not in system_star_counts:
-            # Validate that stars is a number
-            if isinstance(stars, (int, float)):
-                system_star_counts[hostname] = stars
+    for system in get_systems():
+        # Validate that stars is a number
+        if isinstance(system["sy_snum"], (int, float)):
+            system_star_counts.append(system["sy_snum"])
 
     total_systems = len(system_star_counts)
-    total_stars = sum(system_star_counts.values())
+    total_stars = sum(system_star_counts)
 
     if total_systems == 0:
         return "No systems with valid star count found.\n"
@@ -352,6 +798,173 @@ def avg_stars_per_system() -> str:
     output = f"The average number of stars per system is {average:.2f}\n"
     return output
 
+#Route to return every system's record
+@app.route('/systems', methods=['GET'])
+def return_systems():
+    '''
+    This function returns the materialized record of every planetary system,
+    in alphabetical order of hostname.
+
+    Args: none. This function reads the optional query parameters "offset"
+        (default 0) and "limit" (default: every system)
+    Returns:
+        systems (list[dict]): one record per system, with its star and planet
+        counts, distance, position, stellar parameters and member planets
+    '''
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = request.args.get("limit")
+        if limit is not None:
+            limit = int(limit)
+    except ValueError:
+        return "Query parameters offset and limit must be integers\n", 400
+    if offset < 0 or (limit is not None and limit < 1):
+        return "Offset must be non-negative and limit positive\n", 400
+
+    _ensure_indexes()
+    hostnames = get_system_names()
+    if limit is None:
+        hostnames = hostnames[offset:]
+    else:
+        hostnames = hostnames[offset:offset + limit]
+    return get_systems(hostnames)
+
+#Route to return one system's record
+@app.route('/systems/<string:hostname>', methods=['GET'])
+def return_system_info(hostname: str) -> dict:
+    '''
+    This function returns the materialized record of one planetary system.
+
+    Args:
+        hostname (string): a string corresponding to the name of the system
+    Returns:
+        system (dict): the system's star and planet counts, distance, position,
+        stellar parameters and member planets
+    '''
+    _ensure_indexes()
+    system = get_system(hostname)
+    if system is None:
+        return {"System name not found": 0}
+    return system
+
+def _valid_filter(filters) -> bool:
+    '''
+    Checks a job filter, which maps column names to either an exact value or
+    a [low, high] list of inclusive bounds (either may be null)
+
+    Args:
+        filters: the "filter" value of the JSON body of the POST request
+    Returns:
+        valid (bool): True if the filter is well formed
+    '''
+    if not isinstance(filters, dict):
+        return False
+    for condition in filters.values():
+        if isinstance(condition, list):
+            if len(condition) != 2:
+                return False
+            #Bounds are compared with the planets' values by the worker, so
+            #anything but a number would fail the job on every attempt
+            for bound in condition:
+                if bound is None:
+                    continue
+                if isinstance(bound, bool) or not isinstance(bound, (int, float)) or math.isnan(bound):
+                    return False
+    return True
+
+def _parse_atlas_job(content: dict):
+    '''
+    Validates the parameters of an atlas job. "hostnames" is a list of system
+    names, and "filter" is checked by _valid_filter; a system is included if
+    any of its planets match. At least one of them must be given.
+
+    Args:
+        content (dict): the JSON body of the POST request
+    Returns:
+        params (dict): the validated job parameters, or None if invalid
+    '''
+    hostnames = content.get("hostnames")
+    filters = content.get("filter")
+    tiles_per_page = content.get("tiles_per_page", 25)
+    if hostnames is None and filters is None:
+        return None
+    if hostnames is not None:
+        if not isinstance(hostnames, list) or not all(isinstance(h, str) for h in hostnames):
+            return None
+    if filters is not None and not _valid_filter(filters):
+        return None
+    if not isinstance(tiles_per_page, int) or tiles_per_page < 1 or tiles_per_page > 100:
+        return None
+    return {"hostnames": hostnames,
+            "filter": filters,
+            "tiles_per_page": tiles_per_page}
+
+#Media types of the formats an export job can produce
+EXPORT_FORMATS = {"csv": "text/csv",
+                  "ndjson": "application/x-ndjson",
+                  "parquet": "application/vnd.apache.parquet"}
+
+def _parse_export_job(content: dict):
+    '''
+    Validates the parameters of an export job. The optional "filter" (see
+    _valid_filter) selects the planets, the optional "columns" list selects
+    the fields (default all) and must only name columns of the dataset, and
+    "format" is "csv" (default), "ndjson" or "parquet".
+
+    Args:
+        content (dict): the JSON body of the POST request
+    Returns:
+        params (dict): the validated job parameters, or None if invalid
+    '''
+    filters = content.get("filter")
+    columns = content.get("columns")
+    export_format = content.get("format", "csv")
+    if filters is not None and not _valid_filter(filters):
+        return None
+    if columns is not None:
+        if not isinstance(columns, list) or len(columns) == 0 or not all(isinstance(c, str) for c in columns):
+            return None
+        #An unknown column would silently export as an empty field
+        known = set(get_dataset_columns())
+        if not all(c in known for c in columns):
+            return None
+    if export_format not in EXPORT_FORMATS:
+        return None
+    return {"filter": filters,
+            "columns": columns,
+            "format": export_format}
+
+#Route to return statistics for a numeric column
+@app.route('/stats/<string:column>', methods=['GET'])
+def column_stats(column: str):
+    '''
+    This function returns the count, null count, min, max, mean, standard
+    deviation, percentiles and a histogram of any numeric column.
+
+    Args:
+        column (str): the name of a numeric column, e.g. "pl_masse"
+        This function also reads the query parameters "bins" (default 10, at
+        most 1000) and "percentiles" (a comma-separated list, default
+        "5,25,50,75,95")
+    Returns:
+        stats (dict): the column's statistics
+    '''
+    try:
+        bins = int(request.args.get("bins", 10))
+        percentiles = tuple(float(p) for p in
+                            request.args.get("percentiles", "5,25,50,75,95").split(","))
+    except ValueError:
+        return "Query parameter bins must be an integer and percentiles numbers\n", 400
+    if bins < 1 or bins > 1000:
+        return "Query parameter bins must be between 1 and 1000\n", 400
+    if not all(0 <= p <= 100 for p in percentiles):
+        return "Percentiles must be between 0 and 100\n", 400
+
+    snapshot = _get_columns()
+    if column not in snapshot["columns"]:
+        return {"Numeric column not found": 0}
+    return snapshot["stats"](column, bins, percentiles)
+
 #Route to post a new job
 @app.route('/jobs', methods=['POST'])
 def post_job() -> dict:
@@ -360,30 +973,69 @@ def post_job() -> dict:
 
     Args: none. This function assumes the user's POST command included a JSON-
         decipherable string with a value for "planet" corresponding to planet
-        name
+        name, "type": "atlas" along with "hostnames" and/or "filter" (see
+        _parse_atlas_job), or "type": "export" (see _parse_export_job). An
+        optional "priority" of "high", "normal" or "low" defaults to "high" for
+        single systems and "low" for atlases and exports, so bulk jobs never
+        delay interactive ones. The client is identified by the X-Client-Id
+        header, or else by its address, for per-client quotas.
     Returns:
-        job_dict (dict): the dictionary containing the info of the job just posted
+        job_dict (dict): the dictionary containing the info of the job just
+        posted, with its estimated start time, or a 429 error with a
+        Retry-After header if the queue is overloaded (see jobs.submit_job)
     '''
     content = request.get_json()
-    try:
-        def_planet = return_planets()[0] #Default value
-    except IndexError:
+    #Jobs rely on the name index, the systems table and the column list
+    _ensure_indexes()
+    def_planet = get_row(0).get("pl_name") #Default value
+    if def_planet is None:
         logging.error("Database is empty! Did you forget to load the data?")
         return {"Database is empty! Did you forget to load the data?": 0}
 
-    #Check if input is valid
-    #This try/except block should catch any key or type errors
-    try:
-        planet = content["pl_name"]
-    except (TypeError, KeyError):
-        print("Input invalid: defaulting to planet " + str(def_planet))
-        planet = def_planet
-    #Check if input is a planet
-    if(not (planet in return_planets())):
-        print("Planet invalid: defaulting to planet " + str(def_planet))
-        planet = def_planet
-    
-    return add_job(planet)
+    job_type = "system"
+    priority = None
+    if isinstance(content, dict):
+        job_type = content.get("type", "system")
+        priority = content.get("priority")
+    if priority is not None and (not isinstance(priority, str) or priority not in PRIORITIES):
+        return f'Priority must be one of {list(PRIORITIES)}\n', 400
+
+    planet = None
+    if job_type == "atlas":
+        params = _parse_atlas_job(content)
+        if params is None:
+            return "Atlas jobs need a list of \"hostnames\" and/or a \"filter\" object, and \"tiles_per_page\" between 1 and 100\n", 400
+        priority = priority or "low"
+    elif job_type == "export":
+        params = _parse_export_job(content)
+        if params is None:
+            return "Export jobs take an optional \"filter\" object, an optional non-empty list of \"columns\" of the dataset, and a \"format\" of csv, ndjson or parquet\n", 400
+        priority = priority or "low"
+    else:
+        job_type = "system"
+        params = {}
+        priority = priority or "high"
+        #Check if input is valid
+        #This try/except block should catch any key or type errors
+        try:
+            planet = content["pl_name"]
+        except (TypeError, KeyError):
+            print("Input invalid: defaulting to planet " + str(def_planet))
+            planet = def_planet
+        #Check if input is a planet
+        if(not _is_planet(planet)):
+            print("Planet invalid: defaulting to planet " + str(def_planet))
+            planet = def_planet
+
+    #Turn the job away if the queue cannot start it in reasonable time
+    client = request.headers.get("X-Client-Id", request.remote_addr)
+    decision = submit_job(planet, job_type=job_type, params=params,
+                          priority=priority, client=client)
+    if not decision["admitted"]:
+        logging.warning(f'Job rejected: {decision["reason"]}')
+        return (f'{decision["reason"]}, retry in {decision["retry_after"]} s\n', 429,
+                {"Retry-After": str(decision["retry_after"])})
+    return decision["job"]
 
 #Route to get all existing job ids
 @app.route('/jobs', methods=['GET'])
@@ -410,6 +1062,23 @@ def get_job_info(jid: str) -> dict:
     '''
     return get_job_by_id(jid) 
 
+#Route to cancel a job
+@app.route('/jobs/<string:jid>', methods=['DELETE'])
+def delete_job(jid: str) -> str:
+    '''
+    This cancels a job that is queued or in progress
+
+    Args:
+        jid (str): the job's ID as a string
+    Returns:
+        output (str): a string that tells user whether the job was cancelled
+    '''
+    if jid not in get_job_ids():
+        return "Invalid job ID\n"
+    if cancel_job(jid):
+        return "Job cancelled\n"
+    return "Job already finished\n"
+
 @app.route('/download/<string:jid>', methods=['GET'])
 def download(jid: str):
     '''
@@ -418,16 +1087,35 @@ def download(jid: str):
 
     Args:
         jid (str): the job's ID as a string
+        This function also reads the query parameter "page" (default 0), used
+        by atlas jobs whose result spans several images
     Returns:
-        a warning message, or the filepath where to find the image
+        a warning message, or the filepath where to find the image. Export
+        jobs are streamed back chunk by chunk instead.
     '''
+    try:
+        page = int(request.args.get("page", 0))
+    except ValueError:
+        return "Query parameter page must be an integer\n", 400
+
     #check if jid is valid
     if jid in get_job_ids():
-        if get_job_by_id(jid)["status"] == "complete":
-            path = f'/app/{jid}.png'
+        job_dict = get_job_by_id(jid)
+        if job_dict["status"] == "complete" and job_dict.get("type") == "export":
+            chunks = job_dict.get("chunks", 0)
+            export_format = job_dict.get("format", "csv")
+            return Response((get_result(jid, n) for n in range(chunks)),
+                            mimetype=EXPORT_FORMATS[export_format],
+                            headers={"Content-Disposition": f'attachment; filename={jid}.{export_format}'})
+        if job_dict["status"] == "complete":
+            if page < 0 or page >= job_dict.get("pages", 1):
+                return "Invalid page for this job\n"
+            path = f'/app/{jid}-{page}.png'
             with open(path, 'wb') as f:
-                f.write(get_result(jid))
+                f.write(get_result(jid, page))
             return send_file(path, mimetype='image/png', as_attachment=True)
+        elif job_dict["status"] in ("failed", "cancelled"):
+            return f'Job {job_dict["status"]}, there is no result to download\n'
         else:
             return "Job not finished yet\n"
     else:
@@ -443,18 +1131,72 @@ def help_route() -> str:
         help_text (str): help text with descriptions and curl examples for each route
     '''
     help_text = """
-Routes:\n-------\n1. GET /data\n   - Description: Returns all exoplanet data from Redis.\n   - curl: curl http://localhost:5000/data\n\n2. GET /planets\n   - Description: Returns a list of all planet names.\n   - curl: curl http://localhost:5000/planets\n\n3. GET /planets/<pl_name>\n   - Description: Returns data for a specific planet. Replace <pl_name> with planet name.\n   - curl: curl http://localhost:5000/planets/<pl_name>\n\n4. GET /planets/number\n   - Description: Returns the total number of planets in the dataset.\n   - curl: curl http://localhost:5000/planets/number\n\n5. GET /planets/facilities\n   - Description: Returns a count of discovery facilities.\n   - curl: curl http://localhost:5000/planets/facilities\n\n6. GET /planets/years\n   - Description: Returns a count of planets discovered by year.\n   - curl: curl http://localhost:5000/planets/years\n\n7. GET /planets/methods\n   - Description: Returns a count of discoveries by method.\n   - curl: curl http://localhost:5000/planets/methods\n\n8. GET /planets/average_planets \n   - Description: Returns the average number of planets per system.\n   - curl: curl http://localhost:5000/planets/average_planets\n\n9. GET /systems/average_stars \n   - Description: Returns the average number of stars per system.\n   - curl: curl http://localhost:5000/systems/average_stars\n\n10. GET /jobs\n   - Description: Lists all submitted jobs.\n   - curl: curl http://localhost:5000/jobs\n\n11. GET /jobs/<id>\n   - Description: Returns the input parameters and job type for a specific job. Replace <id> with job ID.\n   - curl: curl http://localhost:5000/jobs/<id>\n\n12. GET /download/<id>\n    - Description: Returns the result of a completed job. Replace <id> with job ID.\n    - curl: curl http://localhost:5000/download/<id> --output output.png\n\n13. GET /help\n    - Description: Shows this help message with all available routes.\n    - curl: curl http://localhost:5000/help\n\n14. POST /data\n    - Description: Load exoplanet data into Redis.\n    - curl: curl -X POST http://localhost:5000/data\n\n15. POST /jobs\n    - Description: Submit a job with parameters in JSON format.\n    - curl: curl -X POST -H "Content-Type: application/json" -d '{"pl_name":"Kepler-22 b"}' http://localhost:5000/jobs\n\n16. DELETE /data\n    - Description: Remove all data from Redis.\n    - curl: curl -X DELETE http://localhost:5000/data\n
+Routes:\n-------\n1. GET /data\n   - Description: Returns all exoplanet data from Redis.\n   - curl: curl http://localhost:5000/data\n\n2. GET /planets\n   - Description: Returns a list of all planet names.\n   - curl: curl http://localhost:5000/planets\n\n3. GET /planets/<pl_name>\n   - Description: Returns data for a specific planet. Replace <pl_name> with planet name.\n   - curl: curl http://localhost:5000/planets/<pl_name>\n\n4. GET /planets/number\n   - Description: Returns the total number of planets in the dataset.\n   - curl: curl http://localhost:5000/planets/number\n\n5. GET /planets/facilities\n   - Description: Returns a count of discovery facilities.\n   - curl: curl http://localhost:5000/planets/facilities\n\n6. GET /planets/years\n   - Description: Returns a count of planets discovered by year.\n   - curl: curl http://localhost:5000/planets/years\n\n7. GET /planets/methods\n   - Description: Returns a count of discoveries by method.\n   - curl: curl http://localhost:5000/planets/methods\n\n8. GET /planets/average_planets \n   - Description: Returns the average number of planets per system.\n   - curl: curl http://localhost:5000/planets/average_planets\n\n9. GET /systems/average_stars \n   - Description: Returns the average number of stars per system.\n   - curl: curl http://localhost:5000/systems/average_stars\n\n10. GET /jobs\n   - Description: Lists all submitted jobs.\n   - curl: curl http://localhost:5000/jobs\n\n11. GET /jobs/<id>\n   - Description: Returns the input parameters and job type for a specific job. Replace <id> with job ID.\n   - curl: curl http://localhost:5000/jobs/<id>\n\n12. GET /download/<id>\n    - Description: Returns the result of a completed job. Replace <id> with job ID.\n    - curl: curl http://localhost:5000/download/<id> --output output.png\n\n13. GET /help\n    - Description: Shows this help message with all available routes.\n    - curl: curl http://localhost:5000/help\n\n14. POST /data\n    - Description: Load exoplanet data into Redis.\n    - curl: curl -X POST http://localhost:5000/data\n\n15. POST /jobs\n    - Description: Submit a job with parameters in JSON format.\n    - curl: curl -X POST -H "Content-Type: application/json" -d '{"pl_name":"Kepler-22 b"}' http://localhost:5000/jobs\n\n16. DELETE /data\n    - Description: Remove all data from Redis.\n    - curl: curl -X DELETE http://localhost:5000/data\n\n17. GET /planets/near?ra=<ra>&dec=<dec>&radius=<deg>&limit=<n>\n    - Description: Returns the closest <n> (default 100, at most 1000) planets within <deg> degrees of a point on the sky.\n    - curl: curl "http://localhost:5000/planets/near?ra=290.4&dec=41.5&radius=2"\n\n18. GET /planets/<pl_name>/neighbors?k=<k>\n    - Description: Returns the k (at most 1000) planets closest in space to a specific planet.\n    - curl: curl "http://localhost:5000/planets/Kepler-22%20b/neighbors?k=5"\n\n19. GET /planets/search?<column>_min=<low>&<column>_max=<high>&fields=<columns>&offset=<n>&limit=<n>\n    - Description: Returns planets whose pl_masse, pl_rade, pl_orbper, pl_orbsmax, sy_dist, disc_year or st_teff fall within the given bounds, one page at a time.\n    - curl: curl "http://localhost:5000/planets/search?pl_masse_min=0.5&pl_masse_max=2&pl_orbper_max=50&fields=pl_name,pl_masse"\n\n20. POST /jobs (atlas)\n    - Description: Submit an atlas job that renders many systems as tiles on one or more pages. Give a list of "hostnames" and/or a "filter" mapping columns to a value or [low, high] bounds.\n    - curl: curl -X POST -H "Content-Type: application/json" -d '{"type":"atlas","filter":{"sy_pnum":[2,null]}}' http://localhost:5000/jobs\n\n21. GET /download/<id>?page=<n>\n    - Description: Returns page <n> of the result of a completed atlas job.\n    - curl: curl "http://localhost:5000/download/<id>?page=1" --output page1.png\n\n22. DELETE /jobs/<id>\n    - Description: Cancels a queued or running job. Replace <id> with job ID.\n    - curl: curl -X DELETE http://localhost:5000/jobs/<id>\n\n23. GET /ready\n    - Description: Returns Ready once the API can reach Redis and has built its indexes, or a 503 error otherwise.\n    - curl: curl http://localhost:5000/ready\n\n24. GET /planets/suggest?q=<prefix>&field=<pl_name|hostname>&limit=<n>&ignore_case=<true|false>\n    - Description: Returns up to <n> planet or host names starting with <prefix>.\n    - curl: curl "http://localhost:5000/planets/suggest?q=Kepler-4&limit=10"\n\n25. GET /stats/<column>?bins=<n>&percentiles=<list>\n    - Description: Returns count, null count, min, max, mean, standard deviation, percentiles and a histogram for a numeric column.\n    - curl: curl "http://localhost:5000/stats/pl_masse?bins=20&percentiles=10,50,90"\n\n26. GET /systems?offset=<n>&limit=<n>\n    - Description: Returns the record of every planetary system, optionally one page at a time.\n    - curl: curl http://localhost:5000/systems?limit=10\n\n27. GET /systems/<hostname>\n    - Description: Returns the record of a specific system: star and planet counts, distance, stellar parameters and member planets.\n    - curl: curl http://localhost:5000/systems/Kepler-11\n\n28. POST /jobs (export)\n    - Description: Submit an export job that writes the planets matching an optional "filter" to a csv, ndjson or parquet file with the chosen "columns". Download it with GET /download/<id>.\n    - curl: curl -X POST -H "Content-Type: application/json" -d '{"type":"export","filter":{"disc_year":[2020,null]},"columns":["pl_name","disc_year"],"format":"csv"}' http://localhost:5000/jobs\n
 """
     return help_text
 
+#Readiness route for the Kubernetes readiness probe
+@app.route('/ready', methods=['GET'])
+def ready_route():
+    '''
+    Reports whether this API can serve requests, i.e. whether Redis is
+    reachable and the startup indexes are built. Returns 503 otherwise so
+    Kubernetes keeps traffic away.
+
+    Args: None
+    Returns:
+        output (str): "Ready" or a reason for not being ready
+    '''
+    try:
+        rd.ping()
+    except redis.exceptions.ConnectionError:
+        return "Redis unreachable\n", 503
+    if not _indexes_ready.is_set():
+        return "Building indexes\n", 503
+    return "Ready\n"
+
+@app.before_request
+def _log_first_request() -> None:
+    '''
+    Logs the time from startup to the first request this API serves
+
+    Args: none
+    Returns: none
+    '''
+    global _served_first_request
+    if not _served_first_request:
+        _served_first_request = True
+        logging.warning(f'Time to first request: {time.time() - _start_time:.2f} s')
+
 #Debugging route
 @app.route('/debug', methods=['GET'])
 def debug_route() -> str:
     return "Hello world!\n"
 
+def _warm_indexes() -> None:
+    '''
+    Builds the in-memory indexes, and the Redis indexes if the stored data
+    has none, and then marks the API ready. This runs in the background so
+    that it does not delay the first request.
+
+    Args: none
+    Returns: none
+    '''
+    start = time.time()
+    try:
+        _ensure_indexes()
+        _get_spatial_index()
+        logging.info(f'Indexes built in {time.time() - start:.2f} s')
+    except redis.exceptions.ConnectionError:
+        logging.error(f'Database not found, indexes will be built on first use')
+    _indexes_ready.set()
+    return
+
 def main():
-    #Run Flask
-    app.run(debug=True, host='0.0.0.0')
+    threading.Thread(target=_warm_indexes, daemon=True).start()
+    #Run Flask. The reloader would re-import the whole app in a child process,
+    #doubling startup time
+    app.run(debug=True, host='0.0.0.0', use_reloader=False)
 
 if __name__ == '__main__':
     main()
@@ -4,19 +4,122 @@ import uuid
 import redis
 import os
 import logging
-from datetime import date
-from hotqueue import HotQueue
+import time
+import math
+from datetime import date, datetime, timedelta, timezone
 
 _redis_ip = os.environ.get('REDIS_IP')
 _redis_port = '6379'
 _log_level = os.environ.get('LOG_LEVEL')
 
 rd = redis.Redis(host=_redis_ip, port=6379, db=0)
-q = HotQueue("queue", host=_redis_ip, port=6379, db=1)
+qdb = redis.Redis(host=_redis_ip, port=6379, db=1)
 jdb = redis.Redis(host=_redis_ip, port=6379, db=2)
 res = redis.Redis(host=_redis_ip, port=6379, db=3)
 logging.basicConfig(level=_log_level)
 
+#Jobs are popped lowest rank first, and in submission order within a rank
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+#A worker must heartbeat within this many seconds or its job is requeued
+LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 60))
+#A job that has been attempted this many times is marked failed
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+#Scores are rank * _RANK_SPAN + sequence number
+_RANK_SPAN = 10**12
+
+#Admission control limits, see submit_job; 0 disables a limit
+MAX_QUEUE_DEPTH = int(os.environ.get('MAX_QUEUE_DEPTH', 1000))
+MAX_WAIT_SECONDS = int(os.environ.get('MAX_WAIT_SECONDS', 0))
+CLIENT_MAX_JOBS = int(os.environ.get('CLIENT_MAX_JOBS', 0))
+#Worker throughput is measured over the jobs finished in this many seconds
+THROUGHPUT_WINDOW = 300
+#Assumed duration of a job until throughput has been measured
+DEFAULT_JOB_SECONDS = 5
+#Cached atlas tiles expire after this many seconds unused, so the cache does
+#not grow without bound
+TILE_TTL_SECONDS = int(os.environ.get('TILE_TTL_SECONDS', 7 * 24 * 3600))
+
+#Pops the first job ranked at most ARGV[1], and atomically records its lease,
+#the worker holding it and the attempt, so a job is never lost between
+#dequeueing and starting it
+_dequeue_script = qdb.register_script("""
+local item = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #item == 0 then
+    return nil
+end
+redis.call('ZREM', KEYS[1], item[1])
+redis.call('ZADD', KEYS[2], ARGV[2], item[1])
+redis.call('HSET', KEYS[3], item[1], ARGV[3])
+redis.call('HINCRBY', KEYS[4], item[1], 1)
+return item[1]
+""")
+
+#Extends the lease on job ARGV[1] to ARGV[3], only if worker ARGV[2] still
+#holds it. Returns 1 if the lease was extended.
+_extend_script = qdb.register_script("""
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+""")
+
+#Removes the lease on job ARGV[1] and returns its number of attempts, or -1 if
+#the caller may not. A worker (ARGV[2]) may only release a lease it holds;
+#with no worker given, only a lease that expired before ARGV[3] is released.
+#A worker whose lease expired and was handed to another worker therefore
+#cannot touch the new owner's lease.
+_release_script = qdb.register_script("""
+if ARGV[2] ~= '' then
+    if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+        return -1
+    end
+else
+    local deadline = redis.call('ZSCORE', KEYS[1], ARGV[1])
+    if not deadline or tonumber(deadline) > tonumber(ARGV[3]) then
+        return -1
+    end
+end
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+""")
+
+_LEASE_KEYS = ["queue:leases", "queue:owner", "queue:attempts"]
+
+#Checks the admission limits against the live queue and, only if they all
+#pass, queues job ARGV[1] and counts it against its client, in one step so
+#that concurrent submissions cannot overshoot a limit. Returns the reason
+#(0 if admitted, else 1 for depth, 2 for wait, 3 for the client's quota) and
+#the jobs ahead and client's jobs it was decided on. Only jobs of the same or
+#higher priority count towards the depth, so queued bulk jobs never lock out
+#interactive ones.
+_admit_script = qdb.register_script("""
+local ahead = redis.call('ZCOUNT', KEYS[1], '-inf', ARGV[3])
+local client_jobs = 0
+if ARGV[8] == '1' then
+    client_jobs = redis.call('SCARD', KEYS[3])
+end
+local max_depth, max_wait, client_max = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+if max_depth > 0 and ahead >= max_depth then
+    return {1, ahead, client_jobs}
+end
+if max_wait > 0 and ahead / tonumber(ARGV[7]) > max_wait then
+    return {2, ahead, client_jobs}
+end
+if client_max > 0 and client_jobs >= client_max then
+    return {3, ahead, client_jobs}
+end
+local seq = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[1], tonumber(ARGV[2]) + seq, ARGV[1])
+if ARGV[8] == '1' then
+    redis.call('SADD', KEYS[3], ARGV[1])
+end
+return {0, ahead, client_jobs}
+""")
+
 def _generate_jid() -> str:
     '''
     Generates a pseudo-random id for a job
@@ -27,7 +130,8 @@ def _generate_jid() -> str:
     '''
     return str(uuid.uuid4())
 
-def _instantiate_job(jid: str, status: str, planet: str) -> dict:
+def _instantiate_job(jid: str, status: str, planet: str, job_type: str,
+                     params: dict, priority: str) -> dict:
     '''
     Generates a description of a job object as a dictionary
 
@@ -35,12 +139,19 @@ def _instantiate_job(jid: str, status: str, planet: str) -> dict:
         jid (str): a string that is the ID for a job
         status (str): the status of that job
         planet (str): the planet whose system to visualize
+        job_type (str): the kind of job, "system" or "atlas"
+        params (dict): any extra parameters for this job type
+        priority (str): the job's priority, a key of PRIORITIES
     Returns:
         job_dict (dict): a dictionary containing all the args
     '''
-    return {'id': jid,
-            'status': status,
-            'planet': planet}
+    job_dict = {'id': jid,
+                'status': status,
+                'type': job_type,
+                'priority': priority,
+                'planet': planet}
+    job_dict.update(params)
+    return job_dict
 
 def _save_job(jid: str, job_dict: dict) -> None:
     '''
@@ -55,16 +166,18 @@ def _save_job(jid: str, job_dict: dict) -> None:
     jdb.set(jid, json.dumps(job_dict))
     return
 
-def _queue_job(jid: str) -> None:
+def _queue_job(jid: str, priority: str) -> None:
     '''
-    Add job to Redis queue
+    Add job to the Redis priority queue
 
     Args:
         jid (str): a string that is the ID for the job
+        priority (str): the job's priority, a key of PRIORITIES
     Returns: none
     '''
     logging.info(f'Job queued')
-    q.put(jid)
+    seq = qdb.incr("queue:seq")
+    qdb.zadd("queue:pending", {jid: PRIORITIES[priority] * _RANK_SPAN + seq})
     return
 
 def _add_result(jid: str) -> None:
@@ -80,20 +193,29 @@ def _add_result(jid: str) -> None:
     res.set(jid, temp_str)
     return
 
-def add_job(planet: str, status="submitted") -> dict:
+def _create_job(planet: str, status: str, job_type: str, params: dict,
+                priority: str, client) -> dict:
     '''
-    The function that generates ID and job description and adds it to the queue
+    Generates an ID and job description, and saves it along with the default
+    result, without queueing the job
 
     Args:
-        planet (str): the planet whose system to visualize
-        status (str): the status of that job, by default, "submitted"
+        planet (str): the planet whose system to visualize, None for atlases
+        status (str): the status of that job
+        job_type (str): the kind of job
+        params (dict): any extra parameters for this job type
+        priority (str): "high", "normal" or "low"
+        client (str): the client submitting the job, or None
     Returns:
         job_dict (dict): the dictionary containing all the job information
     '''
+    if params is None:
+        params = {}
     jid = _generate_jid()
-    job_dict = _instantiate_job(jid, status, planet)
+    if client is not None:
+        params = dict(params, client=client)
+    job_dict = _instantiate_job(jid, status, planet, job_type, params, priority)
     _save_job(jid, job_dict) #save to jdb
-    _queue_job(jid) #now add to queue
     _add_result(jid) #now add it to results database
     return job_dict
 
@@ -129,47 +251,340 @@ def get_job_ids() -> list:
             jid_list.append(i.decode())
     return jid_list
 
-def update_job_status(jid: str, status: str) -> None:
+def update_job_status(jid: str, status: str, unless=()) -> bool:
     '''
     Update the status of job with ID jid
 
     Args:
         jid (str): a string that is the ID for the job
         status (str): the new status of the job
+        unless (tuple): statuses that the job must not be in, see update_job
+    Returns:
+        updated (bool): False if the job is missing or in a status in unless
+    '''
+    return update_job(jid, {"status": status}, unless)
+
+def update_job(jid: str, fields: dict, unless=()) -> bool:
+    '''
+    Update fields of the job with ID jid, e.g. its status or the number of
+    result pages. The job is read and written back in one WATCH transaction,
+    so a concurrent update, such as a cancellation, is never overwritten.
+
+    Args:
+        jid (str): a string that is the ID for the job
+        fields (dict): the fields to add or overwrite in the job description
+        unless (tuple): statuses that block the update, e.g. ("cancelled",)
+            so that a cancelled job is not marked running or complete
+    Returns:
+        updated (bool): False if the job is missing or in a status in unless
+    '''
+    with jdb.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(jid)
+                job_json = pipe.get(jid)
+                if job_json is None:
+                    return False
+                job_dict = json.loads(job_json)
+                if job_dict.get("status") in unless:
+                    return False
+                job_dict.update(fields)
+                pipe.multi()
+                pipe.set(jid, json.dumps(job_dict))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                #Another client changed the job first; read it again
+                continue
+
+#Update these as needed for the image return
+def dequeue_job(worker_id: str, max_priority="low"):
+    '''
+    Take the next job off the queue, highest priority first, and lease it to
+    the calling worker for LEASE_SECONDS
+
+    Args:
+        worker_id (str): a string identifying the worker taking the job
+        max_priority (str): the lowest priority this worker accepts, so that
+            some workers can be reserved for interactive jobs
+    Returns:
+        jid (str): the ID of the leased job, or None if the queue is empty
+    '''
+    max_score = PRIORITIES[max_priority] * _RANK_SPAN + (_RANK_SPAN - 1)
+    jid = _dequeue_script(keys=["queue:pending"] + _LEASE_KEYS,
+                          args=[max_score, time.time() + LEASE_SECONDS, worker_id])
+    if jid is None:
+        return None
+    return jid.decode()
+
+def heartbeat(worker_id: str, jid=None) -> bool:
+    '''
+    Record that a worker is alive, and extend the lease on its current job
+
+    Args:
+        worker_id (str): a string identifying the worker
+        jid (str): the ID of the job the worker is running, if any
+    Returns:
+        held (bool): False if the worker no longer holds the job's lease,
+            because it expired and the job was requeued
+    '''
+    pipe = qdb.pipeline()
+    pipe.set(f'worker:{worker_id}', jid if jid is not None else "idle",
+             ex=LEASE_SECONDS)
+    pipe.zadd("queue:workers", {worker_id: time.time()})
+    pipe.zremrangebyscore("queue:workers", "-inf", time.time() - 10 * LEASE_SECONDS)
+    pipe.execute()
+    if jid is None:
+        return True
+    #Only the lease's owner may renew it, so a requeued job is not reclaimed
+    return _extend_script(keys=_LEASE_KEYS[:2],
+                          args=[jid, worker_id, time.time() + LEASE_SECONDS]) == 1
+
+def _release_client(jid: str) -> None:
+    '''
+    Stop counting a finished job against its client's quota
+
+    Args:
+        jid (str): a string that is the ID for the job
+    Returns: none
+    '''
+    client = get_job_by_id(jid).get("client")
+    if client is not None:
+        qdb.srem(f'client:{client}', jid)
+    return
+
+def _release_lease(jid: str, worker_id=None) -> int:
+    '''
+    Atomically remove a job's lease, see _release_script
+
+    Args:
+        jid (str): a string that is the ID for the job
+        worker_id (str): the worker releasing its own lease, or None to
+            release the lease only if it has expired
+    Returns:
+        attempts (int): the number of times the job has been attempted, or -1
+            if the lease was not released
+    '''
+    return int(_release_script(keys=_LEASE_KEYS,
+                               args=[jid, worker_id or "", time.time()]))
+
+def finish_job(jid: str, worker_id: str) -> None:
+    '''
+    Release the lease of a job that the worker is done with, and record its
+    completion for the throughput estimate. Does nothing if the worker's lease
+    expired and the job was handed to another worker.
+
+    Args:
+        jid (str): a string that is the ID for the job
+        worker_id (str): a string identifying the worker that ran the job
     Returns: none
     '''
+    if _release_lease(jid, worker_id) < 0:
+        logging.warning(f'Worker {worker_id} no longer holds the lease on job {jid}')
+        return
+    now = time.time()
+    pipe = qdb.pipeline()
+    pipe.hdel("queue:attempts", jid)
+    pipe.zadd("queue:completed", {jid: now})
+    pipe.zremrangebyscore("queue:completed", "-inf", now - THROUGHPUT_WINDOW)
+    pipe.execute()
+    _release_client(jid)
+    return
+
+def retry_job(jid: str, worker_id=None) -> None:
+    '''
+    Put a job whose attempt failed back on the queue, or mark it failed once
+    it has been attempted MAX_ATTEMPTS times
+
+    Args:
+        jid (str): a string that is the ID for the job
+        worker_id (str): the worker whose attempt failed, or None to retry the
+            job only if its lease has expired
+    Returns: none
+    '''
+    #Only whoever removes the lease gets to requeue, so a job whose lease
+    #expires while its worker is failing it is not queued twice
+    attempts = _release_lease(jid, worker_id)
+    if attempts < 0:
+        return
     job_dict = get_job_by_id(jid)
-    try:
-        job_dict['status'] = status
-        _save_job(jid, job_dict)
-    except KeyError:
-        raise Exception()
+    #A job cancelled meanwhile keeps its status and is dropped
+    if attempts >= MAX_ATTEMPTS:
+        if update_job(jid, {"status": "failed", "attempts": attempts}, unless=("cancelled",)):
+            logging.error(f'Job {jid} failed after {attempts} attempts')
+    elif update_job(jid, {"status": "submitted", "attempts": attempts}, unless=("cancelled",)):
+        logging.warning(f'Requeueing job {jid} after {attempts} attempts')
+        _queue_job(jid, job_dict.get("priority", "normal"))
+        return
+    qdb.hdel("queue:attempts", jid)
+    _release_client(jid)
     return
 
-#Update these as needed for the image return
-def update_result(jid: str, result: bytes) -> None:
+def requeue_expired_jobs() -> None:
+    '''
+    Requeue every job whose worker stopped heartbeating before finishing it
+
+    Args: none
+    Returns: none
+    '''
+    for jid in qdb.zrangebyscore("queue:leases", "-inf", time.time()):
+        retry_job(jid.decode())
+    return
+
+def cancel_job(jid: str) -> bool:
+    '''
+    Cancel a job that has not finished. A queued job is removed from the queue;
+    a running job is marked cancelled and is not retried or marked complete.
+
+    Args:
+        jid (str): a string that is the ID for the job
+    Returns:
+        cancelled (bool): False if the job had already finished
+    '''
+    if not update_job_status(jid, "cancelled", unless=("complete", "failed", "cancelled")):
+        return False
+    #A running job is released by its worker once it stops
+    if qdb.zrem("queue:pending", jid) == 1:
+        _release_client(jid)
+    return True
+
+def get_throughput() -> float:
+    '''
+    Estimates how many jobs per second the workers finish, from the jobs
+    finished in the last THROUGHPUT_WINDOW seconds. Until at least two have
+    finished, every live worker is assumed to take DEFAULT_JOB_SECONDS per job.
+
+    Args: none
+    Returns:
+        throughput (float): the estimated number of jobs finished per second
+    '''
+    now = time.time()
+    finished = qdb.zrangebyscore("queue:completed", now - THROUGHPUT_WINDOW, "+inf",
+                                 withscores=True)
+    if len(finished) >= 2:
+        return len(finished) / max(now - finished[0][1], 1.0)
+    workers = qdb.zcount("queue:workers", now - LEASE_SECONDS, "+inf")
+    return max(workers, 1) / DEFAULT_JOB_SECONDS
+
+def submit_job(planet: str, job_type="system", params=None,
+               priority="normal", client=None) -> dict:
+    '''
+    Adds a job to the queue only if the live queue depth, the workers'
+    throughput and the client's quota allow it, and estimates when it will
+    start. Only jobs of the same or higher priority are counted ahead of it,
+    both for the estimate and for the depth limit. The limits are checked and the job queued atomically, see _admit_script.
+
+    Args:
+        planet (str): the planet whose system to visualize, None for atlases
+        job_type (str): the kind of job, by default, "system"
+        params (dict): any extra parameters for this job type
+        priority (str): "high", "normal" or "low", by default "normal"
+        client (str): a string identifying the client submitting the job
+    Returns:
+        decision (dict): "admitted" (bool), "wait" (estimated seconds until
+            the job starts), "job" (the job description) for admitted jobs,
+            and for rejections, "reason" and "retry_after" (seconds until the
+            client should try again)
+    '''
+    rate = get_throughput()
+    max_score = (PRIORITIES[priority] + 1) * _RANK_SPAN - 1
+    #The saved estimate is read ahead of the atomic check below, since the job
+    #must be saved before a worker can take it off the queue
+    wait = qdb.zcount("queue:pending", "-inf", max_score) / rate
+    start = datetime.now(timezone.utc) + timedelta(seconds=wait)
+    params = dict(params or {},
+                  estimated_wait_seconds=round(wait, 1),
+                  estimated_start=start.isoformat(timespec='seconds'))
+    job_dict = _create_job(planet, "submitted", job_type, params, priority, client)
+    jid = job_dict["id"]
+
+    reason, ahead, client_jobs = _admit_script(
+        keys=["queue:pending", "queue:seq", f'client:{client}'],
+        args=[jid, PRIORITIES[priority] * _RANK_SPAN, max_score, MAX_QUEUE_DEPTH,
+              MAX_WAIT_SECONDS, CLIENT_MAX_JOBS, repr(rate),
+              "1" if client is not None else "0"])
+    wait = ahead / rate
+    if reason == 0:
+        logging.info(f'Job queued')
+        return {"admitted": True, "wait": wait, "job": job_dict}
+
+    jdb.delete(jid)
+    res.delete(jid)
+    if reason == 1:
+        return {"admitted": False, "wait": wait,
+                "reason": f'Queue is full ({ahead} jobs of equal or higher priority waiting)',
+                "retry_after": max(1, math.ceil((ahead - MAX_QUEUE_DEPTH + 1) / rate))}
+    if reason == 2:
+        return {"admitted": False, "wait": wait,
+                "reason": f'Estimated wait of {wait:.0f} s is too long',
+                "retry_after": max(1, math.ceil(wait - MAX_WAIT_SECONDS))}
+    return {"admitted": False, "wait": wait,
+            "reason": f'Client already has {client_jobs} unfinished jobs',
+            "retry_after": max(1, math.ceil(1 / rate))}
+
+def _result_key(jid: str, page: int) -> str:
+    #Page 0 lives at the job ID itself so single-image jobs are unchanged
+    if page == 0:
+        return jid
+    return f'{jid}:page:{page}'
+
+def update_result(jid: str, result: bytes, page=0) -> None:
     '''
     Update the result of a completed job to database "res"
 
     Args:
         jid (str): a string that is the ID for the job
         result (dict): the result returned by worker script, an image in bytes
+        page (int): which page of a multi-page result this is, by default 0
     Returns: none
     '''
-    res.set(jid, result)
+    res.set(_result_key(jid, page), result)
     return
 
-def get_result(jid: str) -> bytes:
+def get_result(jid: str, page=0) -> bytes:
     '''
     Returns the result of the job given its jid
 
     Args:
         jid (str): a string that is the ID for the job
+        page (int): which page of a multi-page result to return, by default 0
     Returns:
         result (bytes): the result of the job in bytes
     '''
     try:
-        return res.get(jid)
+        return res.get(_result_key(jid, page))
     except TypeError:
         s = "Error: no job found for given ID"
         return s.encode("utf-8")
+
+def get_tiles(keys: list) -> list:
+    '''
+    Returns cached atlas tiles from the results database, and renews the
+    expiry of those found
+
+    Args:
+        keys (list): the cache keys of the tiles
+    Returns:
+        tiles (list): the PNG bytes for each key, or None where not cached
+    '''
+    if len(keys) == 0:
+        return []
+    pipe = res.pipeline(transaction=False)
+    pipe.mget([f'tile:{key}' for key in keys])
+    for key in keys:
+        pipe.expire(f'tile:{key}', TILE_TTL_SECONDS)
+    return pipe.execute()[0]
+
+def save_tiles(tiles: dict) -> None:
+    '''
+    Caches rendered atlas tiles in the results database for TILE_TTL_SECONDS
+
+    Args:
+        tiles (dict): a dictionary mapping cache keys to PNG bytes
+    Returns: none
+    '''
+    pipe = res.pipeline(transaction=False)
+    for key, tile in tiles.items():
+        pipe.set(f'tile:{key}', tile, ex=TILE_TTL_SECONDS)
+    pipe.execute()
+    return
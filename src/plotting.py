@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import io
+import math
+import numpy as np
+from matplotlib.figure import Figure
+import matplotlib.image as mpimg
+from typing import List, Tuple
+
+STAR_CONST = 1090 #this will be in terms of solar radii. 1090 is a good
+# number for the plot
+P_SIZE = 10 #in terms of earth radii
+P_ORBIT = 10 #in terms of earth semi-major axes, or aus
+
+TILE_SIZE = 4 #width and height of an atlas tile in inches
+TILE_DPI = 60
+
+def draw_system(ax, planet_data: dict, hostname: str,
+                host_data: List[dict]) -> None:
+    '''
+    Draw the planetary system on a set of matplotlib axes
+
+    Args:
+        ax (Axes): the matplotlib axes to draw on
+        planet_data (dict): the dict containing all of the planet's info
+        hostname (str): the name of the planetary system containing the planet
+        host_data (list[dict]): a list of all dicts with the same hostname
+    Returns: none
+    '''
+    try:
+        n_stars = planet_data["sy_snum"]
+    except KeyError:
+        n_stars = 1 #Default value
+    if n_stars == None:
+        n_stars = 1 #Default value
+
+    star_size, star_color, y_s = [], [], []
+    #r is an arbitrary "radius" - only use is in making sure the stars don't
+    #overlap, but it's not perfect
+    r = .1 * (n_stars-1)
+    x_s = np.random.rand(n_stars)
+    x_s = x_s.tolist()
+
+    for i in range(n_stars):
+        #Find stellar radius
+        try:
+            st_rad = planet_data["st_rad"]
+        except KeyError:
+            st_rad = 1
+        if st_rad == None:
+            st_rad = 1
+
+        star_size.append(st_rad * STAR_CONST)
+
+        #Stellar temperature tells us its "color" - red for cooler and blue
+        #for hotter.
+        try:
+            st_teff = planet_data["st_teff"]
+        except KeyError:
+            st_teff = 5772 #Sun's temperature in Kelvin - default
+        if st_teff == None:
+            st_teff = 5772 #Sun's temperature in Kelvin - default
+        if st_teff < 5000:
+            star_color.append('lightcoral')
+        elif st_teff > 10000:
+            star_color.append('paleturquoise')
+        else:
+            star_color.append('gold')
+
+        #Generate random coordinates for the stars (if there are more than 1)
+        x_s[i] = (x_s[i] * r * 2) - r
+        y_s.append(np.sqrt((r*r) - (x_s[i]*x_s[i])))
+        if np.random.rand() < 0.5:
+            y_s[i] = y_s[i] * -1
+
+    try:
+        n_planets = planet_data["sy_pnum"]
+    except KeyError:
+        n_planets = 1 #Default value
+    if n_planets == None:
+        n_planets = 1 #Default value
+    #sy_pnum can count planets that are missing from the dataset
+    if len(host_data) > 0:
+        n_planets = min(n_planets, len(host_data))
+
+    p_size, p_orbit, p_color, y_p = [], [], [], []
+    x_p = np.random.rand(n_planets)
+    x_p = x_p.tolist()
+
+    for i in range(n_planets):
+        #Find planet's radius for each planet
+        try:
+            pl_rade = host_data[i]["pl_rade"]
+        except KeyError:
+            pl_rade = 1
+        if pl_rade == None:
+            pl_rade = 1
+
+        p_size.append(pl_rade * P_SIZE)
+
+        #Find planet's semi-major axis
+        try:
+            pl_orbsmax = host_data[i]["pl_orbsmax"]
+        except KeyError:
+            pl_orbsmax = 1
+        if pl_orbsmax == None:
+            pl_orbsmax = 1
+
+        orbit = pl_orbsmax * P_ORBIT
+        p_orbit.append(orbit)
+
+        #Generate random coordinates for the planets
+        x_p[i] = (x_p[i] * orbit * 2) - orbit
+        y_p.append(np.sqrt((orbit*orbit) - (x_p[i]*x_p[i])))
+        if np.random.rand() < 0.5:
+            y_p[i] = y_p[i]*-1
+        p_color.append('slategray')
+
+    #Now concatenate lists to scatter
+    x = x_s + x_p
+    y = y_s + y_p
+    size = star_size + p_size
+    color = star_color + p_color
+
+    title = "Visual of Planetary System " + hostname
+    o_int = int(np.max(p_orbit) + 1) #This sets the scale
+
+    ax.scatter(x, y, size, color)
+    ax.set_xticks([-1*o_int, 0, o_int])
+    ax.set_yticks([-1*o_int, 0, o_int])
+    ax.set_title(title)
+    ax.set_xlabel("Distances not to scale. Axes labels in 0.1 au.")
+    return
+
+def render_tile(system: Tuple[str, List[dict]]) -> bytes:
+    '''
+    Render one planetary system as a small PNG tile. This does not touch
+    pyplot's global state, so tiles can be rendered in parallel processes.
+
+    Args:
+        system (tuple): the hostname and the list of all its planets' dicts
+    Returns:
+        tile (bytes): the PNG image of the system
+    '''
+    hostname, host_data = system
+    fig = Figure(figsize=(TILE_SIZE, TILE_SIZE))
+    ax = fig.add_subplot()
+    draw_system(ax, host_data[0], hostname, host_data)
+    ax.title.set_fontsize(9)
+    ax.xaxis.label.set_fontsize(7)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=TILE_DPI)
+    return buf.getvalue()
+
+def compose_page(tiles: List[bytes]) -> bytes:
+    '''
+    Assemble PNG tiles into one composite image laid out as a square grid
+
+    Args:
+        tiles (list[bytes]): the PNG tiles for this page
+    Returns:
+        page (bytes): the PNG image of the whole page
+    '''
+    n_cols = math.ceil(math.sqrt(len(tiles)))
+    n_rows = math.ceil(len(tiles) / n_cols)
+    fig = Figure(figsize=(n_cols * TILE_SIZE, n_rows * TILE_SIZE))
+    for i in range(len(tiles)):
+        ax = fig.add_subplot(n_rows, n_cols, i + 1)
+        ax.imshow(mpimg.imread(io.BytesIO(tiles[i]), format='png'))
+        ax.axis('off')
+    fig.subplots_adjust(left=0, right=1, bottom=0, top=1, wspace=0, hspace=0)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=TILE_DPI)
+    return buf.getvalue()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import math
+import heapq
+from typing import List, Tuple
+
+def sky_to_cartesian(ra: float, dec: float, dist: float = 1.0) -> Tuple[float, float, float]:
+    '''
+    Converts a sky position and distance to 3D Cartesian coordinates
+
+    Args:
+        ra (float): right ascension in degrees
+        dec (float): declination in degrees
+        dist (float): distance from the Sun, by default 1 (a unit vector)
+    Returns:
+        point (tuple): the (x, y, z) coordinates in the same units as dist
+    '''
+    ra_rad = math.radians(ra)
+    dec_rad = math.radians(dec)
+    return (dist * math.cos(dec_rad) * math.cos(ra_rad),
+            dist * math.cos(dec_rad) * math.sin(ra_rad),
+            dist * math.sin(dec_rad))
+
+def angle_to_chord(angle: float) -> float:
+    '''
+    Converts an angular separation on the unit sphere to the straight-line
+    distance between the two unit vectors
+
+    Args:
+        angle (float): the angular separation in degrees
+    Returns:
+        chord (float): the chord length between the two points
+    '''
+    #Anything past 180 degrees covers the whole sphere
+    angle = min(angle, 180.0)
+    return 2 * math.sin(math.radians(angle) / 2)
+
+def chord_to_angle(chord: float) -> float:
+    '''
+    Converts a chord length between two unit vectors back to an angle
+
+    Args:
+        chord (float): the chord length between the two points
+    Returns:
+        angle (float): the angular separation in degrees
+    '''
+    return math.degrees(2 * math.asin(min(chord / 2, 1.0)))
+
+def _squared_distance(a: Tuple[float, ...], b: Tuple[float, ...]) -> float:
+    return sum((a[i] - b[i]) ** 2 for i in range(len(a)))
+
+class KDTree:
+    '''
+    A static k-d tree over 3D points. Each point carries an id (here, the
+    planet's index in the Redis database) that is returned by the queries.
+    Queries visit O(log n) nodes on average instead of scanning every point.
+    '''
+
+    def __init__(self, points: List[Tuple[float, float, float]], ids: List[int]):
+        '''
+        Builds the tree by recursively splitting on the median of each axis
+
+        Args:
+            points (list[tuple]): the (x, y, z) coordinates of each point
+            ids (list[int]): the id for each point, in the same order
+        '''
+        self.size = len(points)
+        self._root = self._build(list(zip(points, ids)), 0)
+
+    def _build(self, items: List[tuple], depth: int):
+        if len(items) == 0:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        median = len(items) // 2
+        #Nodes are stored as (point, id, axis, left, right) tuples
+        return (items[median][0], items[median][1], axis,
+                self._build(items[:median], depth + 1),
+                self._build(items[median + 1:], depth + 1))
+
+    def query_radius(self, point: Tuple[float, float, float],
+                     radius: float) -> List[Tuple[float, int]]:
+        '''
+        Finds every point within a given distance of the query point
+
+        Args:
+            point (tuple): the (x, y, z) coordinates to search around
+            radius (float): the search radius
+        Returns:
+            matches (list[tuple]): (distance, id) pairs sorted by distance
+        '''
+        matches = []
+        r2 = radius * radius
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            node_point, node_id, axis, left, right = node
+            d2 = _squared_distance(point, node_point)
+            if d2 <= r2:
+                matches.append((math.sqrt(d2), node_id))
+            diff = point[axis] - node_point[axis]
+            #Only descend into the far side if the sphere crosses the split
+            if diff <= radius:
+                stack.append(left)
+            if diff >= -radius:
+                stack.append(right)
+        matches.sort()
+        return matches
+
+    def query_knn(self, point: Tuple[float, float, float],
+                  k: int) -> List[Tuple[float, int]]:
+        '''
+        Finds the k points closest to the query point
+
+        Args:
+            point (tuple): the (x, y, z) coordinates to search around
+            k (int): the number of neighbors to return
+        Returns:
+            matches (list[tuple]): (distance, id) pairs sorted by distance
+        '''
+        if k <= 0:
+            return []
+        #Max-heap of the best k so far, stored with negated distances
+        best = []
+
+        def visit(node):
+            if node is None:
+                return
+            node_point, node_id, axis, left, right = node
+            d2 = _squared_distance(point, node_point)
+            if len(best) < k:
+                heapq.heappush(best, (-d2, node_id))
+            elif d2 < -best[0][0]:
+                heapq.heapreplace(best, (-d2, node_id))
+            diff = point[axis] - node_point[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if len(best) < k or diff * diff < -best[0][0]:
+                visit(far)
+
+        visit(self._root)
+        return sorted((math.sqrt(-d2), node_id) for d2, node_id in best)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+import json
+import redis
+import os
+import logging
+from typing import List
+
+_redis_ip = os.environ.get('REDIS_IP')
+_log_level = os.environ.get('LOG_LEVEL')
+
+#Layout of the planet rows in db 0. "json" stores each planet as one JSON
+#string at key i; "hash" stores it as a Redis hash of its non-null fields at
+#key i, with each value JSON-encoded, so that callers can fetch only the
+#fields they need
+LAYOUT = os.environ.get('STORAGE_LAYOUT', 'json')
+#Number of rows sent to Redis per pipeline round trip
+_CHUNK = 1000
+
+#Fields copied from the first planet that has them into its system's record
+SYSTEM_FIELDS = ["sy_snum", "sy_pnum", "sy_dist", "ra", "dec", "st_spectype",
+                 "st_teff", "st_rad", "st_mass", "st_met", "st_logg", "st_age"]
+
+rd = redis.Redis(host=_redis_ip, port=6379, db=0)
+#Database 4 holds dataset metadata, indexes and the materialized systems table,
+#so that db 0 only ever contains planet rows
+idx = redis.Redis(host=_redis_ip, port=6379, db=4)
+logging.basicConfig(level=_log_level)
+
+def count_rows() -> int:
+    '''
+    Returns the number of planets stored
+
+    Args: none
+    Returns:
+        count (int): the number of planet rows in db 0
+    '''
+    return rd.dbsize()
+
+def save_rows(list_of_dicts: List[dict]) -> None:
+    '''
+    Stores the dataset in db 0, planet i at key i
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset
+    Returns: none
+    '''
+    for start in range(0, len(list_of_dicts), _CHUNK):
+        pipe = rd.pipeline(transaction=False)
+        for i in range(start, min(start + _CHUNK, len(list_of_dicts))):
+            if LAYOUT == "hash":
+                #A reload may drop fields, so the old hash must not be merged into
+                pipe.delete(i)
+                fields = {k: json.dumps(v) for k, v in list_of_dicts[i].items()
+                          if v is not None}
+                if len(fields) > 0:
+                    pipe.hset(i, mapping=fields)
+            else:
+                pipe.set(i, json.dumps(list_of_dicts[i]))
+        pipe.execute()
+    save_columns(list_of_dicts)
+    return
+
+def save_columns(list_of_dicts: List[dict]) -> None:
+    '''
+    Stores the names of every column in the dataset, in the order they first
+    appear. The hash layout leaves out null fields, so the full list is kept
+    separately.
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset
+    Returns: none
+    '''
+    columns = {}
+    for row in list_of_dicts:
+        for column in row:
+            columns[column] = True
+    idx.set("columns", json.dumps(list(columns)))
+    return
+
+def get_columns() -> List[str]:
+    '''
+    Returns the names of every column in the dataset
+
+    Args: none
+    Returns:
+        columns (list[str]): the column names, empty if no data is loaded
+    '''
+    columns = idx.get("columns")
+    if columns is None:
+        return []
+    return json.loads(columns)
+
+def delete_rows() -> None:
+    '''
+    Deletes every planet row from db 0
+
+    Args: none
+    Returns: none
+    '''
+    indices = count_rows()
+    for start in range(0, indices, _CHUNK):
+        rd.delete(*range(start, min(start + _CHUNK, indices)))
+    idx.delete("columns")
+    return
+
+def _decode_hash(row: dict) -> dict:
+    return {k.decode(): json.loads(v) for k, v in row.items()}
+
+def get_row(i: int) -> dict:
+    '''
+    Returns the planet stored at index i, or an empty dict if missing
+
+    Args:
+        i (int): the planet's index in the Redis database
+    Returns:
+        data (dict): the planet's data
+    '''
+    try:
+        if LAYOUT == "hash":
+            return _decode_hash(rd.hgetall(i))
+        return json.loads(rd.get(i))
+    except (TypeError, json.decoder.JSONDecodeError):
+        return {}
+
+def get_rows(indices=None) -> List[dict]:
+    '''
+    Returns the full data of many planets, fetched in pipelined chunks
+
+    Args:
+        indices (list[int]): the planets' indices, by default every planet
+    Returns:
+        list_of_dicts (list[dict]): the planets' data in the order of indices,
+            with an empty dict for any row that is missing or invalid
+    '''
+    if indices is None:
+        indices = range(count_rows())
+    indices = list(indices)
+    list_of_dicts = []
+    for start in range(0, len(indices), _CHUNK):
+        chunk = indices[start:start + _CHUNK]
+        if LAYOUT == "hash":
+            pipe = rd.pipeline(transaction=False)
+            for i in chunk:
+                pipe.hgetall(i)
+            list_of_dicts.extend(_decode_hash(row) for row in pipe.execute())
+        else:
+            for row in rd.mget(chunk):
+                try:
+                    list_of_dicts.append(json.loads(row))
+                except (TypeError, json.decoder.JSONDecodeError):
+                    list_of_dicts.append({})
+    return list_of_dicts
+
+def get_fields(fields: List[str], indices=None) -> List[dict]:
+    '''
+    Returns only some fields of many planets. With the "hash" layout this
+    pipelines one HMGET per planet, so the rest of each row is never sent or
+    decoded.
+
+    Args:
+        fields (list[str]): the names of the fields to return
+        indices (list[int]): the planets' indices, by default every planet
+    Returns:
+        list_of_dicts (list[dict]): for each planet, a dict with every field in
+            fields, set to None where the planet has no value
+    '''
+    if indices is None:
+        indices = range(count_rows())
+    indices = list(indices)
+    if LAYOUT != "hash":
+        return [{field: row.get(field) for field in fields}
+                for row in get_rows(indices)]
+
+    list_of_dicts = []
+    for start in range(0, len(indices), _CHUNK):
+        pipe = rd.pipeline(transaction=False)
+        for i in indices[start:start + _CHUNK]:
+            pipe.hmget(i, fields)
+        for values in pipe.execute():
+            list_of_dicts.append({fields[j]: json.loads(values[j]) if values[j] is not None else None
+                                  for j in range(len(fields))})
+    return list_of_dicts
+
+def delete_systems() -> None:
+    '''
+    Deletes the materialized systems table
+
+    Args: none
+    Returns: none
+    '''
+    hostnames = [h.decode() for h in idx.zrange("systems", 0, -1)]
+    for start in range(0, len(hostnames), _CHUNK):
+        idx.delete(*[f'system:{h}' for h in hostnames[start:start + _CHUNK]])
+    idx.delete("systems", "planet_hosts")
+    return
+
+def save_systems(list_of_dicts: List[dict]) -> None:
+    '''
+    Materializes one record per hostname, so that system-level questions are
+    answered by a single lookup instead of regrouping the planet rows. Each
+    record holds the system's SYSTEM_FIELDS, its number of planets in the
+    dataset, and the indices and names of its planets. The "planet_hosts" hash
+    maps each planet name to its hostname.
+
+    Args:
+        list_of_dicts (list[dict]): the exoplanet dataset, indexed as in db 0
+    Returns: none
+    '''
+    systems = {}
+    planet_hosts = {}
+    for i in range(len(list_of_dicts)):
+        hostname = list_of_dicts[i].get("hostname")
+        if hostname is None:
+            continue
+        system = systems.setdefault(hostname, {"hostname": hostname,
+                                               "planet_count": 0,
+                                               "planets": [],
+                                               "planet_names": []})
+        system["planet_count"] += 1
+        system["planets"].append(i)
+        system["planet_names"].append(list_of_dicts[i].get("pl_name"))
+        for field in SYSTEM_FIELDS:
+            if system.get(field) is None:
+                system[field] = list_of_dicts[i].get(field)
+        if list_of_dicts[i].get("pl_name") is not None:
+            planet_hosts[list_of_dicts[i]["pl_name"]] = hostname
+
+    delete_systems()
+    names = list(systems.keys())
+    for start in range(0, len(names), _CHUNK):
+        chunk = names[start:start + _CHUNK]
+        pipe = idx.pipeline(transaction=False)
+        pipe.mset({f'system:{h}': json.dumps(systems[h]) for h in chunk})
+        #Scores are all 0, so hostnames are kept in alphabetical order
+        pipe.zadd("systems", {h: 0 for h in chunk})
+        pipe.execute()
+    if len(planet_hosts) > 0:
+        idx.hset("planet_hosts", mapping=planet_hosts)
+    return
+
+def get_system_names() -> List[str]:
+    '''
+    Returns every hostname in the systems table, in alphabetical order
+
+    Args: none
+    Returns:
+        hostnames (list[str]): the names of all systems
+    '''
+    return [h.decode() for h in idx.zrange("systems", 0, -1)]
+
+def get_systems(hostnames=None) -> List[dict]:
+    '''
+    Returns the records of many systems
+
+    Args:
+        hostnames (list[str]): the systems to return, by default every system
+    Returns:
+        systems (list[dict]): the systems' records, leaving out unknown hostnames
+    '''
+    if hostnames is None:
+        hostnames = get_system_names()
+    systems = []
+    for start in range(0, len(hostnames), _CHUNK):
+        chunk = hostnames[start:start + _CHUNK]
+        for row in idx.mget([f'system:{h}' for h in chunk]):
+            if row is not None:
+                systems.append(json.loads(row))
+    return systems
+
+def get_system(hostname: str):
+    '''
+    Returns the record of one system
+
+    Args:
+        hostname (str): the name of the system
+    Returns:
+        system (dict): the system's record, or None if there is no such system
+    '''
+    row = idx.get(f'system:{hostname}')
+    if row is None:
+        return None
+    return json.loads(row)
+
+def get_planet_host(pl_name: str):
+    '''
+    Returns the hostname of a planet
+
+    Args:
+        pl_name (str): the name of the planet
+    Returns:
+        hostname (str): the planet's hostname, or None if the planet is unknown
+    '''
+    hostname = idx.hget("planet_hosts", pl_name)
+    if hostname is None:
+        return None
+    return hostname.decode()
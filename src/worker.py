@@ -1,23 +1,52 @@
 #!/usr/bin/env python3
-from jobs import get_job_by_id, get_job_ids, update_job_status, add_job, update_result
-import queue
-from hotqueue import HotQueue
-import redis
 import time
+_start_time = time.time()
+from jobs import get_job_by_id, update_job_status, update_job, update_result, get_tiles, save_tiles
+from jobs import dequeue_job, heartbeat, finish_job, retry_job, requeue_expired_jobs, LEASE_SECONDS
+from storage import get_fields, get_systems, get_system, get_planet_host, get_columns, count_rows
+import socket
+import redis
+import threading
 import os
 import json
 import logging
-import matplotlib.pyplot as plt
-import numpy as np
+import hashlib
+import multiprocessing
+import csv
+import io
 from typing import List, Tuple
 
 redis_ip = os.environ.get('REDIS_IP')
 log_level = os.environ.get('LOG_LEVEL')
 
-rd = redis.Redis(host=redis_ip, port=6379, db=0)
-q = HotQueue("queue", host=redis_ip, port=6379, db=1)
 logging.basicConfig(level=log_level)
 
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+#Lowest priority this worker takes, e.g. "high" to reserve it for interactive jobs
+WORKER_MAX_PRIORITY = os.environ.get('WORKER_MAX_PRIORITY', 'low')
+POLL_SECONDS = 0.5
+#Touched once the worker has warmed up and can reach Redis, for the
+#Kubernetes readiness probe
+READY_FILE = os.environ.get('WORKER_READY_FILE', '/tmp/worker-ready')
+
+#Atlas jobs render tiles across this many processes (default: every core
+#this container may run on)
+ATLAS_PROCESSES = int(os.environ.get('ATLAS_PROCESSES', len(os.sched_getaffinity(0))))
+#Forking this worker while its heartbeat thread runs can deadlock the child,
+#so atlas processes are started by a fork server instead. It preloads the
+#plotting module, so they do not each import matplotlib again.
+_atlas_context = multiprocessing.get_context("forkserver")
+_atlas_context.set_forkserver_preload(["plotting"])
+ATLAS_TILES_PER_PAGE = 25
+#Export jobs read this many rows at a time, and store their output in result
+#chunks of about this many bytes, so memory use does not grow with the export
+EXPORT_ROWS = 1000
+EXPORT_CHUNK_BYTES = 1 << 20
+
+#The only fields plotting.draw_system reads, so jobs fetch nothing else
+PLOT_FIELDS = ["pl_name", "hostname", "sy_snum", "sy_pnum", "st_rad", "st_teff",
+               "pl_rade", "pl_orbsmax"]
+
 def plot_image(jid: str, planet_data: dict, hostname: str, 
                host_data: List[dict]) -> None:
     '''
@@ -30,116 +59,13 @@ def plot_image(jid: str, planet_data: dict, hostname: str,
         host_data (list[dict]): a list of all dicts with the same hostname
     Returns: none
     '''
-    
-    system = hostname
-    
-    try:
-        n_stars = planet_data["sy_snum"]
-    except KeyError:
-        n_stars = 1 #Default value
-    if n_stars == None:
-        n_stars = 1 #Default value
-    
-    STAR_CONST = 1090 #this will be in terms of solar radii. 1090 is a good
-    # number for the plot
-
-    star_size, star_color, y_s = [], [], []
-    #r is an arbitrary "radius" - only use is in making sure the stars don't
-    #overlap, but it's not perfect
-    r = .1 * (n_stars-1)
-    x_s = np.random.rand(n_stars)
-    x_s = x_s.tolist()
-
-    for i in range(n_stars):
-        #Find stellar radius
-        try:
-            st_rad = planet_data["st_rad"]
-        except KeyError:
-            st_rad = 1
-        if st_rad == None:
-            st_rad = 1
+    #matplotlib and NumPy are imported on first use, not at startup
+    import matplotlib.pyplot as plt
+    from plotting import draw_system
 
-        star_size.append(st_rad * STAR_CONST)
-        
-        #Stellar temperature tells us its "color" - red for cooler and blue
-        #for hotter.
-        try:
-            st_teff = planet_data["st_teff"]
-        except KeyError:
-            st_teff = 5772 #Sun's temperature in Kelvin - default
-        if st_teff == None:
-            st_teff = 5772 #Sun's temperature in Kelvin - default
-        if st_teff < 5000:
-            star_color.append('lightcoral')
-        elif st_teff > 10000:
-            star_color.append('paleturquoise')
-        else:
-            star_color.append('gold')
-        
-        #Generate random coordinates for the stars (if there are more than 1)
-        x_s[i] = (x_s[i] * r * 2) - r
-        y_s.append(np.sqrt((r*r) - (x_s[i]*x_s[i])))
-        if np.random.rand() < 0.5:
-            y_s[i] = y_s[i] * -1
-    
-    try:
-        n_planets = planet_data["sy_pnum"]
-    except KeyError:
-        n_planets = 1 #Default value
-    if n_planets == None:
-        n_planets = 1 #Default value
-
-    P_SIZE = 10 #in terms of earth radii
-    P_ORBIT = 10 #in terms of earth semi-major axes, or aus
-
-    p_size, p_orbit, p_color, y_p = [], [], [], []
-    x_p = np.random.rand(n_planets)
-    x_p = x_p.tolist()
-
-    for i in range(n_planets):
-        #Find planet's radius for each planet
-        try:
-            pl_rade = host_data[i]["pl_rade"]
-        except KeyError:
-            pl_rade = 1
-        if pl_rade == None:
-            pl_rade = 1
-        
-        p_size.append(pl_rade * P_SIZE)
-        
-        #Find planet's semi-major axis
-        try:
-            pl_orbsmax = host_data[i]["pl_orbsmax"]
-        except KeyError:
-            pl_orbsmax = 1
-        if pl_orbsmax == None:
-            pl_orbsmax = 1
-
-        orbit = pl_orbsmax * P_ORBIT
-        p_orbit.append(orbit)
-        
-        #Generate random coordinates for the planets
-        x_p[i] = (x_p[i] * orbit * 2) - orbit
-        y_p.append(np.sqrt((orbit*orbit) - (x_p[i]*x_p[i])))
-        if np.random.rand() < 0.5:
-            y_p[i] = y_p[i]*-1
-        p_color.append('slategray')
-    
-    #Now concatenate lists to scatter
-    x = x_s + x_p
-    y = y_s + y_p
-    size = star_size + p_size
-    color = star_color + p_color
-    
-    title = "Visual of Planetary System " + hostname
     filename = "/" + hostname + ".png"
-    o_int = int(np.max(p_orbit) + 1) #This sets the scale
-    
-    plt.scatter(x, y, size, color)
-    plt.xticks([-1*o_int, 0, o_int])
-    plt.yticks([-1*o_int, 0, o_int])
-    plt.title(title)
-    plt.xlabel("Distances not to scale. Axes labels in 0.1 au.")
+
+    draw_system(plt.gca(), planet_data, hostname, host_data)
     plt.savefig(filename)
 
     with open (filename, 'rb') as f:
@@ -149,41 +75,302 @@ def plot_image(jid: str, planet_data: dict, hostname: str,
 
     plt.clf() #clear plot for the next job
 
-@q.worker
-def work(jid: str) -> None:
+def _matches_filter(data: dict, filters: dict) -> bool:
     '''
-    Return a diagram of the planetary system given a planet name
+    Checks whether a planet matches every condition of a job filter. Each
+    condition is either an exact value, or a [low, high] list of inclusive
+    bounds where either bound may be null.
+
+    Args:
+        data (dict): the planet's data
+        filters (dict): a dictionary mapping column names to conditions
+    Returns:
+        match (bool): True if the planet satisfies every condition
+    '''
+    for column, condition in filters.items():
+        value = data.get(column)
+        if isinstance(condition, list):
+            low, high = condition
+            if not isinstance(value, (int, float)):
+                return False
+            if low is not None and value < low:
+                return False
+            if high is not None and value > high:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+def _tile_key(hostname: str, host_data: List[dict]) -> str:
+    '''
+    Returns the cache key for an atlas tile, which changes whenever any field
+    the tile draws changes. Other fields, such as those a filter fetched, are
+    left out so they neither split nor invalidate the cache.
+
+    Args:
+        hostname (str): the name of the planetary system
+        host_data (list[dict]): a list of all dicts with the same hostname
+    Returns:
+        key (str): a hash of the system's plotted data
+    '''
+    plotted = [{field: row.get(field) for field in PLOT_FIELDS} for row in host_data]
+    blob = json.dumps([hostname, plotted], sort_keys=True)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+def render_atlas(jid: str, job_dict: dict) -> None:
+    '''
+    Render many planetary systems as tiles in parallel, and assemble them into
+    one or more composite pages. Tiles of systems whose data has not changed
+    since a previous atlas are reused from the cache.
+
+    Args:
+        jid (str): the job's ID as a string
+        job_dict (dict): the job description, with "hostnames" and/or "filter"
+            selecting the systems and "tiles_per_page" setting the page size
+    Returns: none
+    '''
+    from plotting import render_tile, compose_page
+
+    hostnames = job_dict.get("hostnames")
+    if hostnames is not None:
+        hostnames = set(hostnames)
+    filters = job_dict.get("filter")
+    tiles_per_page = job_dict.get("tiles_per_page", ATLAS_TILES_PER_PAGE)
+
+    #A single pass over the dataset groups the selected planets by system
+    systems = {}
+    selected = set()
+    fields = PLOT_FIELDS
+    if filters is not None:
+        fields = PLOT_FIELDS + [f for f in filters if f not in PLOT_FIELDS]
+    if hostnames is not None and filters is None:
+        #The systems table lists the members, so only their rows are fetched
+        indices = [i for system in get_systems(sorted(hostnames))
+                   for i in system["planets"]]
+        list_of_dicts = get_fields(fields, indices)
+    else:
+        list_of_dicts = get_fields(fields)
+    for temp in list_of_dicts:
+        h = temp["hostname"]
+        if h is None:
+            continue
+        if hostnames is not None and h not in hostnames:
+            continue
+        systems.setdefault(h, []).append(temp)
+        if filters is None or _matches_filter(temp, filters):
+            selected.add(h)
+
+    names = sorted(selected)
+    keys = [_tile_key(h, systems[h]) for h in names]
+    tiles = get_tiles(keys)
+    missing = [i for i in range(len(names)) if tiles[i] is None]
+    logging.info(f'Atlas {jid}: {len(names)} systems, {len(missing)} to render')
+
+    with _atlas_context.Pool(ATLAS_PROCESSES) as pool:
+        rendered = pool.map(render_tile,
+                            [(names[i], systems[names[i]]) for i in missing])
+        for i, tile in zip(missing, rendered):
+            tiles[i] = tile
+        save_tiles({keys[i]: tiles[i] for i in missing})
+        pages = [tiles[i:i + tiles_per_page]
+                 for i in range(0, len(tiles), tiles_per_page)]
+        images = pool.map(compose_page, pages)
+
+    for page in range(len(images)):
+        update_result(jid, images[page], page)
+    update_job(jid, {"systems": len(names), "pages": len(images)})
+    return
+
+class _ResultWriter:
+    '''
+    A write-only file object that stores what is written to it as numbered
+    result chunks of about EXPORT_CHUNK_BYTES in the results database
+    '''
+
+    def __init__(self, jid: str):
+        self.jid = jid
+        self.chunks = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._buffer.extend(data)
+        self._position += len(data)
+        if len(self._buffer) >= EXPORT_CHUNK_BYTES:
+            self._store_chunk()
+        return len(data)
+
+    def _store_chunk(self) -> None:
+        if len(self._buffer) > 0:
+            update_result(self.jid, bytes(self._buffer), self.chunks)
+            self.chunks += 1
+            self._buffer = bytearray()
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self) -> None:
+        return
+
+    def close(self) -> None:
+        if not self.closed:
+            self._store_chunk()
+            self.closed = True
+
+def _matching_rows(fields: List[str], columns: List[str], filters):
+    '''
+    Yields the planets that match a filter, EXPORT_ROWS rows at a time
+
+    Args:
+        fields (list[str]): the fields to fetch, the columns plus any fields
+            the filter needs
+        columns (list[str]): the fields to keep in the output
+        filters (dict): the filter, see _matches_filter, or None for every row
+    Returns:
+        rows (generator): lists of dicts holding only the given columns
+    '''
+    indices = count_rows()
+    for start in range(0, indices, EXPORT_ROWS):
+        rows = []
+        for temp in get_fields(fields, range(start, min(start + EXPORT_ROWS, indices))):
+            if filters is None or _matches_filter(temp, filters):
+                rows.append({column: temp[column] for column in columns})
+        yield rows
+
+def _parquet_schema(fields: List[str], columns: List[str], filters):
+    '''
+    Works out a Parquet type for each column from every matching value, since
+    one chunk alone may hold only nulls for a column. Columns mixing numbers
+    and text, or holding only nulls, are stored as strings.
+
+    Args:
+        fields (list[str]): the fields to fetch
+        columns (list[str]): the columns to export
+        filters (dict): the filter, see _matches_filter, or None for every row
+    Returns:
+        schema (pyarrow.Schema): the schema of the export
+    '''
+    import pyarrow as pa
+
+    kinds = {column: set() for column in columns}
+    for rows in _matching_rows(fields, columns, filters):
+        for row in rows:
+            for column in columns:
+                if row[column] is not None:
+                    kinds[column].add(type(row[column]))
+
+    types = []
+    for column in columns:
+        if kinds[column] == {bool}:
+            types.append(pa.bool_())
+        elif kinds[column] == {int}:
+            types.append(pa.int64())
+        elif len(kinds[column]) > 0 and kinds[column] <= {int, float}:
+            types.append(pa.float64())
+        else:
+            types.append(pa.string())
+    return pa.schema(list(zip(columns, types)))
+
+def export_rows(jid: str, job_dict: dict) -> None:
+    '''
+    Write the planets matching a filter to a CSV, NDJSON or Parquet file,
+    streaming it chunk by chunk into the results database
+
+    Args:
+        jid (str): the job's ID as a string
+        job_dict (dict): the job description, with the "filter" selecting the
+            rows, the "columns" to keep (default all) and the "format"
+    Returns: none
+    '''
+    filters = job_dict.get("filter")
+    columns = job_dict.get("columns") or get_columns()
+    export_format = job_dict.get("format", "csv")
+    fields = columns + [f for f in (filters or {}) if f not in columns]
+
+    sink = _ResultWriter(jid)
+    if export_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = _parquet_schema(fields, columns, filters)
+        strings = [field.name for field in schema if field.type == pa.string()]
+        writer = pq.ParquetWriter(sink, schema)
+    elif export_format == "csv":
+        buf = io.StringIO()
+        csv.writer(buf).writerow(columns)
+        sink.write(buf.getvalue().encode("utf-8"))
+
+    n_rows = 0
+    for rows in _matching_rows(fields, columns, filters):
+        n_rows += len(rows)
+        if export_format == "parquet":
+            for row in rows:
+                for column in strings:
+                    if row[column] is not None:
+                        row[column] = str(row[column])
+            #Each chunk becomes one row group, so the file is never held whole
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        elif export_format == "csv":
+            buf = io.StringIO()
+            csv.writer(buf).writerows([[row[column] for column in columns] for row in rows])
+            sink.write(buf.getvalue().encode("utf-8"))
+        else:
+            sink.write("".join(json.dumps(row) + "\n" for row in rows).encode("utf-8"))
+
+    if export_format == "parquet":
+        writer.close()
+    sink.close()
+    update_job(jid, {"rows": n_rows, "chunks": sink.chunks})
+    return
+
+def run_job(jid: str) -> None:
+    '''
+    Return a diagram of the planetary system given a planet name, an atlas of
+    many systems for jobs of type "atlas", or a file of rows for jobs of type
+    "export"
 
     Args:
         jid (str): ID of the job requesting
     Returns: none
     '''
     job_dict = get_job_by_id(jid)   
-    update_job_status(jid, "in progress")
     
     planet_data = {}
     hostname = ""
     host_data = []
-    indices = len(rd.keys())
 
     #Check for wrong jid
     message = "Error: no job found for given ID"
     if message in job_dict:
         logging.error(f'Error: no job found for given ID')
         #No need to update result
+        return
+    #The status is set atomically, so a job cancelled before or while it is
+    #dequeued is dropped rather than marked in progress
+    elif not update_job_status(jid, "in progress", unless=("cancelled",)):
+        return
+    elif job_dict.get("type", "system") == "atlas":
+        render_atlas(jid, job_dict)
+    elif job_dict.get("type", "system") == "export":
+        export_rows(jid, job_dict)
     else:
         planet = job_dict["planet"]
+        #The systems table gives the host's member planets in two lookups; a
+        #full scan is only needed if the table has not been built
+        system = get_system(get_planet_host(planet) or "")
+        if system is not None:
+            list_of_dicts = get_fields(PLOT_FIELDS, system["planets"])
+        else:
+            list_of_dicts = get_fields(PLOT_FIELDS)
         
         #Get data for this planet
-        for i in range(indices):
+        for temp in list_of_dicts:
             #iterate through each dictionary
-            temp = json.loads(rd.get(i))
-            try:
-                pl_name = temp["pl_name"]
-                if planet == pl_name:
-                    planet_data = temp
-            except KeyError:
-                logging.error(f'Invalid key')
+            if planet == temp["pl_name"]:
+                planet_data = temp
 
         #Get hostname
         try:
@@ -192,20 +379,97 @@ def work(jid: str) -> None:
             logging.error(f'Invalid key')
 
         #Get all dictionaries for all planets with same hostname
-        for i in range(indices):
-            temp = json.loads(rd.get(i))
-            try:
-                h = temp["hostname"]
-                if hostname == h:
-                    host_data.append(temp)
-            except KeyError:
-                logging.error(f'Invalid key')
-
-        #Each entry has a hostname and planet name, KeyErrors are unexpected here
+        for temp in list_of_dicts:
+            if hostname == temp["hostname"]:
+                host_data.append(temp)
 
         plot_image(jid, planet_data, hostname, host_data)
         
-    update_job_status(jid, "complete")
+    #A job cancelled while running keeps its "cancelled" status
+    update_job_status(jid, "complete", unless=("cancelled",))
+    return
+
+def _heartbeat_loop(stop: threading.Event, jid: str) -> None:
+    '''
+    Heartbeat every third of a lease until stopped, so the job's lease only
+    expires if this worker dies
+
+    Args:
+        stop (Event): set when the job is done
+        jid (str): ID of the job being run
+    Returns: none
+    '''
+    while not stop.wait(LEASE_SECONDS / 3):
+        #A transient Redis error must not end the heartbeats, or the lease
+        #would expire while the job is still running
+        try:
+            if not heartbeat(WORKER_ID, jid):
+                logging.warning(f'Lost the lease on job {jid}')
+        except redis.exceptions.RedisError:
+            logging.exception(f'Heartbeat for job {jid} failed')
+    return
+
+def warm_up() -> None:
+    '''
+    Import the plotting stack and render a throwaway tile, so that the first
+    real job does not pay for imports, font loading and renderer setup
+
+    Args: none
+    Returns: none
+    '''
+    import matplotlib.pyplot as plt
+    from plotting import render_tile
+
+    #Also create the global figure and axes that plot_image draws on
+    plt.gca()
+    render_tile(("Warm-up", [{"pl_rade": 1, "pl_orbsmax": 1}]))
+    logging.info(f'Worker warmed up in {time.time() - _start_time:.2f} s')
     return
 
-work()
+def work() -> None:
+    '''
+    Take jobs off the priority queue and run them forever. Each job is leased
+    while it runs; if it raises, it is retried up to the attempt limit, and if
+    this worker dies, another worker requeues it once the lease expires.
+
+    Args: none
+    Returns: none
+    '''
+    first_job = True
+    while True:
+        requeue_expired_jobs()
+        jid = dequeue_job(WORKER_ID, WORKER_MAX_PRIORITY)
+        if jid is None:
+            heartbeat(WORKER_ID)
+            time.sleep(POLL_SECONDS)
+            continue
+
+        if first_job:
+            logging.warning(f'Time to first job: {time.time() - _start_time:.2f} s')
+            first_job = False
+        heartbeat(WORKER_ID, jid)
+        stop = threading.Event()
+        beats = threading.Thread(target=_heartbeat_loop, args=(stop, jid), daemon=True)
+        beats.start()
+        try:
+            run_job(jid)
+            finish_job(jid, WORKER_ID)
+        except Exception:
+            logging.exception(f'Job {jid} raised an error')
+            retry_job(jid, WORKER_ID)
+        finally:
+            stop.set()
+            beats.join()
+
+def main():
+    #The readiness file must not survive from a previous run of this container
+    if os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+    warm_up()
+    heartbeat(WORKER_ID)
+    with open(READY_FILE, 'w') as f:
+        f.write(WORKER_ID)
+    work()
+
+if __name__ == '__main__':
+    main()
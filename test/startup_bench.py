@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''
+Measures cold-start times of the containers started by docker compose:
+time-to-first-request (until the API's /ready route returns 200) and
+time-to-first-job (until a freshly started worker completes a job). The
+data must already be loaded into Redis. Run with "make startup-bench".
+'''
+import argparse
+import statistics
+import subprocess
+import time
+import requests
+
+URL = 'http://localhost:5000'
+
+def _wait_for(check, timeout: float) -> float:
+    '''
+    Polls check() until it returns True, and returns how long that took
+
+    Args:
+        check (function): a function returning True once the condition holds
+        timeout (float): seconds to wait before giving up
+    Returns:
+        elapsed (float): seconds until check() returned True
+    '''
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            if check():
+                return time.time() - start
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.05)
+    raise TimeoutError(f'Not ready after {timeout} s')
+
+def time_to_first_request(timeout: float) -> float:
+    '''
+    Restarts the API container and times how long until it is ready
+
+    Args:
+        timeout (float): seconds to wait before giving up
+    Returns:
+        elapsed (float): seconds from restart to the first successful request
+    '''
+    subprocess.run(['docker', 'compose', 'stop', 'flask-app'], check=True)
+    start = time.time()
+    subprocess.run(['docker', 'compose', 'start', 'flask-app'], check=True)
+    _wait_for(lambda: requests.get(f'{URL}/ready').status_code == 200, timeout)
+    return time.time() - start
+
+def time_to_first_job(timeout: float) -> float:
+    '''
+    Restarts the worker container with a job already queued, and times how
+    long until that job is complete
+
+    Args:
+        timeout (float): seconds to wait before giving up
+    Returns:
+        elapsed (float): seconds from restart to the job completing
+    '''
+    subprocess.run(['docker', 'compose', 'stop', 'worker'], check=True)
+    jid = requests.post(f'{URL}/jobs', json={}).json()["id"]
+    start = time.time()
+    subprocess.run(['docker', 'compose', 'start', 'worker'], check=True)
+    _wait_for(lambda: requests.get(f'{URL}/jobs/{jid}').json()["status"] == "complete",
+              timeout)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure container cold-start times')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    requests_times, job_times = [], []
+    for i in range(args.runs):
+        requests_times.append(time_to_first_request(args.timeout))
+        job_times.append(time_to_first_job(args.timeout))
+        print(f'Run {i + 1}: first request {requests_times[-1]:.2f} s, '
+              f'first job {job_times[-1]:.2f} s')
+
+    print(f'Median time to first request: {statistics.median(requests_times):.2f} s')
+    print(f'Median time to first job: {statistics.median(job_times):.2f} s')
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,17 @@ response9 = requests.get(f'http://localhost:5000/planets/average_planets')
 response10 = requests.get(f'http://localhost:5000/systems/average_stars')
 response11 = requests.get(f'http://localhost:5000/jobs')
 response12 = requests.get(f'http://localhost:5000/help')
+response13 = requests.get(f'http://localhost:5000/planets/near?ra=290&dec=44&radius=5&limit=3')
+response14 = requests.get(f'http://localhost:5000/planets/Kepler-10%20b/neighbors?k=3')
+response15 = requests.get(f'http://localhost:5000/planets/search?pl_masse_min=0.5&pl_masse_max=2&pl_orbper_max=50&fields=pl_name,pl_masse&limit=10')
+response16 = requests.post(f'http://localhost:5000/jobs', json={"type": "atlas", "hostnames": ["Kepler-10"]})
+response17 = requests.delete(f'http://localhost:5000/jobs/' + response16.json()["id"])
+response18 = requests.get(f'http://localhost:5000/ready')
+response19 = requests.get(f'http://localhost:5000/planets/suggest?q=kepler-4&ignore_case=true&limit=5')
+response20 = requests.get(f'http://localhost:5000/stats/pl_masse?bins=5')
+response21 = requests.get(f'http://localhost:5000/systems?limit=5')
+response22 = requests.get(f'http://localhost:5000/systems/Kepler-11')
+response23 = requests.post(f'http://localhost:5000/jobs', json={"type": "export", "columns": ["pl_name", "disc_year"], "format": "ndjson"})
 response4 = requests.delete(f'http://localhost:5000/data')
 '''
 def test_load_exoplanet_data():
@@ -53,3 +64,46 @@ def test_get_job_id_list():
 
 def test_help_route():
     assert(isinstance(response12.content.decode("utf-8"), str) == True)
+
+def test_planets_near():
+    assert(isinstance(response13.json(), list) == True)
+    assert(len(response13.json()) <= 3)
+
+def test_planet_neighbors():
+    assert(isinstance(response14.json(), list) == True)
+    assert(len(response14.json()) <= 3)
+
+def test_search_planets():
+    assert(isinstance(response15.json()["results"], list) == True)
+    assert(len(response15.json()["results"]) <= 10)
+
+def test_post_atlas_job():
+    assert(response16.json()["type"] == "atlas")
+
+def test_delete_job():
+    assert(isinstance(response17.content.decode("utf-8"), str) == True)
+
+def test_ready_route():
+    assert(response18.status_code == 200)
+
+def test_suggest_names():
+    assert(isinstance(response19.json(), list) == True)
+    assert(len(response19.json()) <= 5)
+
+def test_column_stats():
+    assert(isinstance(response20.json(), dict) == True)
+    assert(len(response20.json()["histogram"]["counts"]) == 5)
+
+def test_return_systems():
+    assert(isinstance(response21.json(), list) == True)
+    assert(len(response21.json()) <= 5)
+
+def test_return_system_info():
+    assert(isinstance(response22.json(), dict) == True)
+
+def test_post_export_job():
+    assert(response23.json()["type"] == "export")
+    assert(response23.json()["format"] == "ndjson")
+
+def test_post_job_estimated_start():
+    assert(isinstance(response16.json()["estimated_start"], str) == True)